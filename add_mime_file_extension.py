@@ -4,13 +4,25 @@
 # First written 2019-12-28 by <jonas@jonasjberg.com>
 
 import argparse
+import collections
+import cProfile
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import heapq
+import json
 import logging
+import os
 import pathlib
+import re
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
-
-
-sys.exit('TODO: WIP! Needs testing and further development!')
+import threading
+import time
 
 
 _SELF_BASENAME = pathlib.Path(__file__).name
@@ -20,344 +32,68 @@ LOG = logging.getLogger(_SELF_BASENAME)
 USE_AS_IS = object()
 
 
-def examine_application_octet_stream(filepath, mimetype):
-    USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF = {
-        '._.DS_Store',
-        '.DS_Store',
-        '.ICEauthority',
-        '.viminfo',
-        '.Xauthority',
-        'DS_Store',
-    }
-    if filepath.name in USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        '3gp',
-        'axx',
-        'bin',
-        'chm',
-        'dat',
-        'db',
-        'img',
-        'iso',
-        'log',
-        'mobi',
-        'pak',
-        'pdf',
-        'pyc',
-        'raw',
-        'sqldb',
-        'txt',
-        'webarchive',
-        'webm',
-        'xml',
-        'xps',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return None
-
-
-def examine_application_x_dosexec(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'dll',
-        'exe',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return None
-
-
-def examine_application_xml(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'config',
-        'plist',
-        'props',
-        'vcxproj',
-        'xml',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'xml'
-
-
-def examine_application_zip(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'jar',
-        'xps',
-        'zip',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return None
-
-
-def examine_image_png(filepath, mimetype):
-    USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF = {
-        '.face',
-    }
-    if filepath.name in USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'png'
-
-
-def examine_message_rfc_822(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'eml',
-        'html',
-        'mhtml',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return None
-
-
-def examine_text_html(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'erb',
-        'js',
-        'py',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'html'
-
-
-def examine_text_plain(filepath, mimetype):
-    USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF = {
-        '.bash_aliases',
-        '.bash_eternal_history',
-        '.bash_history',
-        '.bash_logout',
-        '.bash_profile',
-        '.bashrc',
-        '.environment',
-        '.filetags',
-        '.fzf.bash',
-        '.gitconfig',
-        '.gnuplot_history',
-        '.gscan2pdf',
-        '.gtk-bookmarks',
-        '.gtk-recordmydesktop',
-        '.ideavimrc',
-        '.inputrc',
-        '.lesshst',
-        '.liquidpromptrc',
-        '.mostrc',
-        '.node_repl_history',
-        '.nvidia-settings-rc',
-        '.profile',
-        '.selected_editor',
-        '.sqlite_history',
-        '.tmux.conf',
-        '.vimrc',
-        '.wget-hsts',
-        '.Xdefaults',
-        '.xinputrc',
-        '.Xmodmap',
-        '.xscreensaver',
-        '.xsession-errors',
-        'AUTHORS',
-        'CHANGELOG',
-        'ChangeLog',
-        'COPYING',
-        'FAQ',
-        'MANIFEST.in',
-        'README',
-        'zshrc',
-    }
-    if filepath.name in USE_AS_IS_IF_BASENAME_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    if filepath.name.startswith('.'):
-        return filepath.suffix
-
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'acsm',
-        'bash',
-        'bib',
-        'c',
-        'cfg',
-        'css',
-        'csv',
-        'desktop',
-        'dic',
-        'h',
-        'html',
-        'ini',
-        'ipynb',
-        'js',
-        'json',
-        'list',
-        'log',
-        'lua',
-        'markdown',
-        'md',
-        'mht',
-        'pl',
-        'py',
-        'raw',
-        'rst',
-        'rtf',
-        'scss',
-        'sh',
-        'txt',
-        'xml',
-        'yaml',
-        'yml',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    USE_AS_IS_IF_BASENAME_ENDSWITH_ANY_OF = {
-        'description',
-        'h.cmakein',
-        'h.in',
-        'info.json',
-        'o.ur-safe',
-        'pc.cmakein',
-        'pc.in',
-    }
-    filepathstr = str(filepath)
-    for ending in USE_AS_IS_IF_BASENAME_ENDSWITH_ANY_OF:
-        if filepathstr.endswith(ending):
-            return ending
-
-    return 'txt'
-
-
-def examine_text_troff(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'py',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return USE_AS_IS
-
-
-def examine_text_x_c(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'c',
-        'cpp',
-        'h',
-        'hpp',
-        'markdown',
-        'md',
-        'rst',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'c'
-
-
-def examine_text_x_cpp(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'c',
-        'cpp',
-        'h',
-        'hpp',
-        'md',
-        'py',
-        'rst',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'cpp'
-
-
-def examine_text_x_python(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'md',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'py'
-
-
-def examine_text_x_fortran(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'f',
-        'F',
-        'f03',
-        'f90',
-        'F90',
-        'f95',
-        'for',
-        'txt',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'for'
-
-
-def examine_video_mp4(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'm4v',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'mp4'
-
-
-def examine_video_mpeg(filepath, mimetype):
-    USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF = {
-        'm4v',
-        'mp4',
-    }
-    extension = str(filepath.suffix).lstrip('.')
-    if extension in USE_AS_IS_IF_CURRENT_EXTENSION_EQUALS_ANY_OF:
-        return USE_AS_IS
-
-    return 'mpg'
-
-
 IGNORED_MIMETYPES = {
     'inode/directory',
     'inode/x-empty',
 }
 
+# Policy for picking file extensions by MIME-type.  Each value is either the
+# extension to use or a dict with any of the following keys, checked in the
+# listed order:
+#
+#   'keep_basenames'           Use as-is if the basename is any of these.
+#   'keep_dotfile_extension'   If true, keep the current extension of
+#                              files with basenames starting with a period.
+#   'keep_extensions'          Use as-is if the current extension is any of
+#                              these.
+#   'basename_endings'         Use the ending as the extension if the
+#                              basename ends with any of these.
+#   'extension'                Otherwise use this extension.
+#   'use_as_is'                Otherwise, if true, use as-is.
+#
+# Additional rules can be loaded from a JSON file of the same structure with
+# '--rules', replacing the rules of any MIME-types it contains.
+#
 # TODO: BUT we want to exclude ~/.python_history! So we need exclusion rules,
 #       like "match this but ALSO DO NOT MATCH THIS" ..
-MIMETYPE_EXTENSION_LOOKUP = {
+MIMETYPE_RULES = {
     'application/CDFV2': 'db',
     'application/CDFV2-unknown': 'msg',
     'application/gzip': 'tar.gz',
     'application/java-archive': 'jar',
     'application/msword': 'doc',
-    'application/octet-stream': examine_application_octet_stream,
+    'application/octet-stream': {
+        'keep_basenames': [
+            '._.DS_Store',
+            '.DS_Store',
+            '.ICEauthority',
+            '.viminfo',
+            '.Xauthority',
+            'DS_Store',
+        ],
+        'keep_extensions': [
+            '3gp',
+            'axx',
+            'bin',
+            'chm',
+            'dat',
+            'db',
+            'img',
+            'iso',
+            'log',
+            'mobi',
+            'pak',
+            'pdf',
+            'pyc',
+            'raw',
+            'sqldb',
+            'txt',
+            'webarchive',
+            'webm',
+            'xml',
+            'xps',
+        ],
+    },
     'application/ogg': 'ogg',
     'application/pdf': 'pdf',
     'application/vnd.debian.binary-package': 'deb',
@@ -372,27 +108,52 @@ MIMETYPE_EXTENSION_LOOKUP = {
     'application/x-7z-compressed': '7z',
     'application/x-bittorrent': 'torrent',
     'application/x-bzip2': 'tar.bz',
-    'application/x-dosexec': examine_application_x_dosexec,
-    'application/x-executable': USE_AS_IS,
+    'application/x-dosexec': {
+        'keep_extensions': [
+            'dll',
+            'exe',
+        ],
+    },
+    'application/x-executable': {'use_as_is': True},
     'application/x-font-ttf': 'ttf',
     'application/x-gzip': 'tar.gz',
     'application/x-lzma': 'lzma',
     'application/x-object': 'o',
     'application/x-rar': 'rar',
     'application/x-setupscript': 'ini',
-    'application/x-sharedlib': USE_AS_IS,
+    'application/x-sharedlib': {'use_as_is': True},
     'application/x-shockwave-flash': 'swf',
     'application/x-tar': 'tar.gz',
     'application/x-xz': 'xz',
-    'application/xml': examine_application_xml,
-    'application/zip': examine_application_zip,
+    'application/xml': {
+        'keep_extensions': [
+            'config',
+            'plist',
+            'props',
+            'vcxproj',
+            'xml',
+        ],
+        'extension': 'xml',
+    },
+    'application/zip': {
+        'keep_extensions': [
+            'jar',
+            'xps',
+            'zip',
+        ],
+    },
     'audio/mpeg': 'mp3',
     'audio/x-flac': 'flac',
     'audio/x-m4a': 'm4a',
     'audio/x-wav': 'wav',
     'image/gif': 'gif',
     'image/jpeg': 'jpg',
-    'image/png': examine_image_png,
+    'image/png': {
+        'keep_basenames': [
+            '.face',
+        ],
+        'extension': 'png',
+    },
     'image/svg+xml': 'svg',
     'image/tiff': 'tif',
     'image/vnd.adobe.photoshop': 'psd',
@@ -401,29 +162,655 @@ MIMETYPE_EXTENSION_LOOKUP = {
     'image/x-icon': 'ico',
     'image/x-ms-bmp': 'bmp',
     'image/x-xcf': 'xcf',
-    'message/rfc822': examine_message_rfc_822,
+    'message/rfc822': {
+        'keep_extensions': [
+            'eml',
+            'html',
+            'mhtml',
+            'txt',
+        ],
+    },
     'text/calendar': 'ics',
-    'text/html': examine_text_html,
-    'text/plain': examine_text_plain,
+    'text/html': {
+        'keep_extensions': [
+            'erb',
+            'js',
+            'py',
+            'txt',
+        ],
+        'extension': 'html',
+    },
+    'text/plain': {
+        'keep_basenames': [
+            '.bash_aliases',
+            '.bash_eternal_history',
+            '.bash_history',
+            '.bash_logout',
+            '.bash_profile',
+            '.bashrc',
+            '.environment',
+            '.filetags',
+            '.fzf.bash',
+            '.gitconfig',
+            '.gnuplot_history',
+            '.gscan2pdf',
+            '.gtk-bookmarks',
+            '.gtk-recordmydesktop',
+            '.ideavimrc',
+            '.inputrc',
+            '.lesshst',
+            '.liquidpromptrc',
+            '.mostrc',
+            '.node_repl_history',
+            '.nvidia-settings-rc',
+            '.profile',
+            '.selected_editor',
+            '.sqlite_history',
+            '.tmux.conf',
+            '.vimrc',
+            '.wget-hsts',
+            '.Xdefaults',
+            '.xinputrc',
+            '.Xmodmap',
+            '.xscreensaver',
+            '.xsession-errors',
+            'AUTHORS',
+            'CHANGELOG',
+            'ChangeLog',
+            'COPYING',
+            'FAQ',
+            'MANIFEST.in',
+            'README',
+            'zshrc',
+        ],
+        'keep_dotfile_extension': True,
+        'keep_extensions': [
+            'acsm',
+            'bash',
+            'bib',
+            'c',
+            'cfg',
+            'css',
+            'csv',
+            'desktop',
+            'dic',
+            'h',
+            'html',
+            'ini',
+            'ipynb',
+            'js',
+            'json',
+            'list',
+            'log',
+            'lua',
+            'markdown',
+            'md',
+            'mht',
+            'pl',
+            'py',
+            'raw',
+            'rst',
+            'rtf',
+            'scss',
+            'sh',
+            'txt',
+            'xml',
+            'yaml',
+            'yml',
+        ],
+        'basename_endings': [
+            'description',
+            'h.cmakein',
+            'h.in',
+            'info.json',
+            'o.ur-safe',
+            'pc.cmakein',
+            'pc.in',
+        ],
+        'extension': 'txt',
+    },
     'text/rtf': 'rtf',
-    'text/troff': examine_text_troff,
+    'text/troff': {'use_as_is': True},
     'text/vcard': 'vcf',
-    'text/x-c': examine_text_x_c,
-    'text/x-c++': examine_text_x_cpp,
-    'text/x-fortran': examine_text_x_fortran,
-    'text/x-makefile': USE_AS_IS,
-    'text/x-python': examine_text_x_python,
+    'text/x-c': {
+        'keep_extensions': [
+            'c',
+            'cpp',
+            'h',
+            'hpp',
+            'markdown',
+            'md',
+            'rst',
+            'txt',
+        ],
+        'extension': 'c',
+    },
+    'text/x-c++': {
+        'keep_extensions': [
+            'c',
+            'cpp',
+            'h',
+            'hpp',
+            'md',
+            'py',
+            'rst',
+            'txt',
+        ],
+        'extension': 'cpp',
+    },
+    'text/x-fortran': {
+        'keep_extensions': [
+            'f',
+            'F',
+            'f03',
+            'f90',
+            'F90',
+            'f95',
+            'for',
+            'txt',
+        ],
+        'extension': 'for',
+    },
+    'text/x-makefile': {'use_as_is': True},
+    'text/x-python': {
+        'keep_extensions': [
+            'md',
+            'txt',
+        ],
+        'extension': 'py',
+    },
     'text/x-ruby': 'rb',
     'text/x-shellscript': 'sh',
     'text/x-tex': 'tex',
-    'video/mp4': examine_video_mp4,
-    'video/mpeg': examine_video_mpeg,
+    'video/mp4': {
+        'keep_extensions': [
+            'm4v',
+        ],
+        'extension': 'mp4',
+    },
+    'video/mpeg': {
+        'keep_extensions': [
+            'm4v',
+            'mp4',
+        ],
+        'extension': 'mpg',
+    },
     'video/ogg': 'ogg',
     'video/quicktime': 'mov',
     'video/x-flv': 'flv',
     'video/x-msvideo': 'avi',
 }
 
+# Compiled form of a single entry in 'MIMETYPE_RULES'.  Basename endings are
+# stored as a trie of reversed endings, see 'compile_basename_endings()'.
+# Rules without any conditions have 'has_conditions' set to False and only
+# need their 'default' looked at.
+CompiledRule = collections.namedtuple(
+    'CompiledRule',
+    [
+        'has_conditions',
+        'keep_basenames',
+        'keep_dotfile_extension',
+        'keep_extensions',
+        'basename_endings_trie',
+        'default',
+    ]
+)
+
+# Key marking the end of an ending in a trie of reversed endings.
+_TRIE_END = ''
+
+
+def compile_basename_endings(endings):
+    """
+    Builds a trie of nested dicts keyed by the characters of the endings in
+    reverse, so that all endings can be matched in a single backward walk
+    over a basename.  Nodes where an ending is complete store the ending
+    under the '_TRIE_END' key.
+    """
+    trie = {}
+    for ending in endings:
+        node = trie
+        for char in reversed(ending):
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = ending
+    return trie
+
+
+def match_basename_ending(trie, basename):
+    """Returns the longest ending in the trie that the basename ends with."""
+    matched_ending = None
+    node = trie
+    for char in reversed(basename):
+        node = node.get(char)
+        if node is None:
+            break
+        matched_ending = node.get(_TRIE_END, matched_ending)
+    return matched_ending
+
+
+def compile_mimetype_rule(rule):
+    if isinstance(rule, str):
+        rule = {'extension': rule}
+
+    unknown_keys = set(rule) - {
+        'basename_endings',
+        'extension',
+        'keep_basenames',
+        'keep_dotfile_extension',
+        'keep_extensions',
+        'use_as_is',
+    }
+    if unknown_keys:
+        raise ValueError('Unknown rule key(s): {}'.format(', '.join(sorted(unknown_keys))))
+
+    if rule.get('extension'):
+        default = rule['extension']
+    elif rule.get('use_as_is'):
+        default = USE_AS_IS
+    else:
+        default = None
+
+    keep_basenames = frozenset(rule.get('keep_basenames', ()))
+    keep_dotfile_extension = bool(rule.get('keep_dotfile_extension', False))
+    keep_extensions = frozenset(rule.get('keep_extensions', ()))
+    basename_endings_trie = compile_basename_endings(rule.get('basename_endings', ()))
+    return CompiledRule(
+        has_conditions=bool(
+            keep_basenames or keep_dotfile_extension or keep_extensions or basename_endings_trie
+        ),
+        keep_basenames=keep_basenames,
+        keep_dotfile_extension=keep_dotfile_extension,
+        keep_extensions=keep_extensions,
+        basename_endings_trie=basename_endings_trie,
+        default=default,
+    )
+
+
+def compile_mimetype_rules(rules):
+    return {
+        mimetype: compile_mimetype_rule(rule)
+        for mimetype, rule in rules.items()
+    }
+
+
+def load_mimetype_rules(filepath):
+    with open(filepath, 'r', encoding='utf8') as filehandle:
+        rules = json.load(filehandle)
+
+    if not isinstance(rules, dict):
+        raise ValueError('Expected a JSON object mapping MIME-types to rules')
+    return rules
+
+
+def get_extension(basename):
+    # Same as 'pathlib.PurePath.suffix' without the leading period.
+    index = basename.rfind('.')
+    if 0 < index < len(basename) - 1:
+        return basename[index + 1:]
+    return ''
+
+
+def classify_basename(basename, compiled_rule):
+    """
+    Returns the extension to use for a file with the given basename, or
+    'USE_AS_IS' or None if the rule does not settle on an extension.
+    """
+    if not compiled_rule.has_conditions:
+        return compiled_rule.default
+
+    if basename in compiled_rule.keep_basenames:
+        return USE_AS_IS
+
+    extension = get_extension(basename)
+    if compiled_rule.keep_dotfile_extension and basename.startswith('.'):
+        return extension
+
+    if extension in compiled_rule.keep_extensions:
+        return USE_AS_IS
+
+    if compiled_rule.basename_endings_trie:
+        ending = match_basename_ending(compiled_rule.basename_endings_trie, basename)
+        if ending is not None:
+            return ending
+
+    return compiled_rule.default
+
+
+COMPILED_MIMETYPE_RULES = compile_mimetype_rules(MIMETYPE_RULES)
+
+
+# Number of files passed to each "file" process and detected together.
+# Also the unit of work handed to each worker thread.
+DEFAULT_BATCH_SIZE = 250
+
+# Number of worker threads detecting MIME-types concurrently.
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# Maximum number of entries kept in the persistent MIME-type cache.
+DEFAULT_CACHE_MAX_ENTRIES = 1000000
+
+# Number of slowest files listed by the stage profile.
+DEFAULT_PROFILE_TOP = 10
+
+# Number of bytes hashed at the start and at the end of files when looking
+# for duplicates, before hashing them in full.
+PARTIAL_HASH_BLOCK_SIZE = 4096
+FULL_HASH_READ_SIZE = 1024 * 1024
+
+# Number of leading bytes read from each file by the in-process sniffer.
+SNIFF_READ_SIZE = 8192
+
+# Simple magic byte signatures checked in order; (offset, magic, MIME-type).
+# Formats that need a closer look at the header are handled separately in
+# 'sniff_binary_mimetype()'.
+MAGIC_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'8BPS', 'image/vnd.adobe.photoshop'),
+    (0, b'gimp xcf ', 'image/x-xcf'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'Rar!\x1a\x07', 'application/x-rar'),
+    (0, b'!<arch>\ndebian-binary', 'application/vnd.debian.binary-package'),
+    (0, b'fLaC', 'audio/x-flac'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'FLV\x01', 'video/x-flv'),
+    (0, b'\x00\x00\x01\xba', 'video/mpeg'),
+    (0, b'\x00\x00\x01\xb3', 'video/mpeg'),
+    (0, b'FWS', 'application/x-shockwave-flash'),
+    (0, b'CWS', 'application/x-shockwave-flash'),
+    (0, b'ZWS', 'application/x-shockwave-flash'),
+    (0, b'OTTO', 'application/vnd.ms-opentype'),
+    (0, b'd8:announce', 'application/x-bittorrent'),
+    (257, b'ustar', 'application/x-tar'),
+)
+
+RIFF_FORMAT_MIMETYPES = {
+    b'AVI ': 'video/x-msvideo',
+    b'WAVE': 'audio/x-wav',
+    b'WEBP': 'image/webp',
+}
+
+ISO_MEDIA_BRAND_MIMETYPES = {
+    b'3g2a': 'video/3gpp2',
+    b'3gp4': 'video/3gpp',
+    b'3gp5': 'video/3gpp',
+    b'avc1': 'video/mp4',
+    b'dash': 'video/mp4',
+    b'F4V ': 'video/mp4',
+    b'iso2': 'video/mp4',
+    b'isom': 'video/mp4',
+    b'M4A ': 'audio/x-m4a',
+    b'M4V ': 'video/mp4',
+    b'mp41': 'video/mp4',
+    b'mp42': 'video/mp4',
+    b'MSNV': 'video/mp4',
+    b'qt  ': 'video/quicktime',
+}
+
+ELF_TYPE_SHARED_OBJECT = 3
+ELF_SEGMENT_TYPE_INTERPRETER = 3
+ELF_TYPE_MIMETYPES = {
+    1: 'application/x-object',
+    2: 'application/x-executable',
+}
+
+# Names of streams in the first directory sector of a "Compound Document File"
+# (OLE2/CDFV2) mapped to the MIME-type reported by libmagic.
+CDF_STREAM_NAME_MIMETYPES = {
+    'Book': 'application/vnd.ms-excel',
+    'Catalog': 'application/CDFV2',
+    'PowerPoint Document': 'application/vnd.ms-powerpoint',
+    'WordDocument': 'application/msword',
+    'Workbook': 'application/vnd.ms-excel',
+}
+
+# Directories stored in "Office Open XML" ZIP archives.
+OOXML_DIRECTORY_MIMETYPES = {
+    b'word/': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    b'xl/': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    b'ppt/': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+
+SHEBANG_INTERPRETER_MIMETYPES = {
+    'bash': 'text/x-shellscript',
+    'dash': 'text/x-shellscript',
+    'ksh': 'text/x-shellscript',
+    'python': 'text/x-python',
+    'python2': 'text/x-python',
+    'python3': 'text/x-python',
+    'ruby': 'text/x-ruby',
+    'sh': 'text/x-shellscript',
+    'zsh': 'text/x-shellscript',
+}
+
+# Leading text of files, compared case-insensitively and ignoring leading
+# whitespace.
+TEXT_PREFIX_MIMETYPES = (
+    ('<!doctype html', 'text/html'),
+    ('<html', 'text/html'),
+    ('begin:vcalendar', 'text/calendar'),
+    ('begin:vcard', 'text/vcard'),
+    ('{\\rtf', 'text/rtf'),
+    ('[autorun]', 'application/x-setupscript'),
+    ('[version]', 'application/x-setupscript'),
+)
+
+# Patterns matched against text in order, first match wins.  Only
+# signatures that no other kind of text starts with belong here; guessing
+# at source code is left to "file", which knows many more languages.
+TEXT_PATTERN_MIMETYPES = (
+    (re.compile(r'\A(Return-Path|Received|Delivered-To|Message-ID|MIME-Version):', re.IGNORECASE), 'message/rfc822'),
+    (re.compile(r'\A(\.\\"|\'\\"|\.TH |\.SH )'), 'text/troff'),
+    (re.compile(r'\A\s*\\(documentclass|documentstyle)\b'), 'text/x-tex'),
+)
+
+RE_TEXT_CONTROL_CHARACTERS = re.compile(rb'[\x00-\x07\x0e-\x1a\x1c-\x1f\x7f]')
+
+
+def _sniff_elf_mimetype(head):
+    if len(head) < 18:
+        return None
+
+    byteorder = '<' if head[5:6] == b'\x01' else '>'
+    (elf_type,) = struct.unpack_from(byteorder + 'H', head, 16)
+    if elf_type != ELF_TYPE_SHARED_OBJECT:
+        return ELF_TYPE_MIMETYPES.get(elf_type)
+
+    # Shared objects might also be position-independent executables, which
+    # request a program interpreter. Leave anything unclear to libmagic.
+    if head[4:5] == b'\x02':
+        header_format, header_offset = 'QQIHHH', 32
+    else:
+        header_format, header_offset = 'IIIHHH', 28
+    if len(head) < header_offset + struct.calcsize(header_format):
+        return None
+
+    program_header_offset, _, _, _, entry_size, entry_count = struct.unpack_from(
+        byteorder + header_format, head, header_offset
+    )
+    for index in range(entry_count):
+        entry_offset = program_header_offset + index * entry_size
+        if entry_offset + 4 > len(head):
+            return None
+        (segment_type,) = struct.unpack_from(byteorder + 'I', head, entry_offset)
+        if segment_type == ELF_SEGMENT_TYPE_INTERPRETER:
+            return None
+
+    return 'application/x-sharedlib'
+
+
+def _sniff_cdf_mimetype(head):
+    if len(head) < 512:
+        return None
+
+    (sector_shift,) = struct.unpack_from('<H', head, 30)
+    (first_directory_sector,) = struct.unpack_from('<i', head, 48)
+    sector_size = 1 << sector_shift
+    offset = (first_directory_sector + 1) * sector_size
+    directory = head[offset:offset + sector_size]
+
+    for entry_offset in range(0, len(directory) - 127, 128):
+        (name_length,) = struct.unpack_from('<H', directory, entry_offset + 64)
+        raw_name = directory[entry_offset:entry_offset + max(0, name_length - 2)]
+        name = raw_name.decode('utf-16-le', errors='replace')
+        if name in CDF_STREAM_NAME_MIMETYPES:
+            return CDF_STREAM_NAME_MIMETYPES[name]
+        if name.startswith('__substg1.0_'):
+            return 'application/CDFV2-unknown'
+
+    return None
+
+
+def _sniff_zip_mimetype(head):
+    if len(head) < 30:
+        return None
+
+    name_length, extra_length = struct.unpack_from('<HH', head, 26)
+    first_name = head[30:30 + name_length]
+    if first_name == b'mimetype':
+        # OpenDocument files store their MIME-type uncompressed first.
+        offset = 30 + name_length + extra_length
+        mimetype = head[offset:offset + 80].split(b'PK', 1)[0]
+        return mimetype.decode('ascii', errors='replace').strip() or None
+
+    if first_name.startswith(b'META-INF/'):
+        return 'application/java-archive'
+
+    if b'[Content_Types].xml' in head or b'_rels/.rels' in head:
+        for directory, mimetype in OOXML_DIRECTORY_MIMETYPES.items():
+            if directory in head:
+                return mimetype
+
+        # Probably Office Open XML but the telling parts are further in.
+        return None
+
+    return 'application/zip'
+
+
+def sniff_binary_mimetype(head):
+    for offset, magic, mimetype in MAGIC_SIGNATURES:
+        if head.startswith(magic, offset):
+            return mimetype
+
+    if head.startswith(b'\x7fELF'):
+        return _sniff_elf_mimetype(head)
+
+    if head.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        return _sniff_cdf_mimetype(head)
+
+    if head.startswith(b'PK\x03\x04'):
+        return _sniff_zip_mimetype(head)
+
+    if head.startswith(b'RIFF'):
+        return RIFF_FORMAT_MIMETYPES.get(head[8:12])
+
+    if head[4:8] == b'ftyp':
+        return ISO_MEDIA_BRAND_MIMETYPES.get(head[8:12])
+
+    if head.startswith(b'OggS'):
+        if b'\x80theora' in head:
+            return 'video/ogg'
+        return 'application/ogg'
+
+    if head.startswith(b'AT&TFORM') and head[12:15] == b'DJV':
+        return 'image/vnd.djvu'
+
+    if head.startswith(b'BM') and head[6:10] == b'\x00\x00\x00\x00':
+        return 'image/x-ms-bmp'
+
+    if head.startswith(b'\x00\x00\x01\x00') and head[4:5] != b'\x00' and head[5:6] == b'\x00':
+        return 'image/x-icon'
+
+    if head.startswith(b'\x00\x01\x00\x00\x00'):
+        return 'application/x-font-ttf'
+
+    if head.startswith(b'\x5d\x00\x00'):
+        return 'application/x-lzma'
+
+    if head.startswith(b'MZ'):
+        return 'application/x-dosexec'
+
+    if head[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+
+    return None
+
+
+def sniff_text_mimetype(head):
+    if RE_TEXT_CONTROL_CHARACTERS.search(head):
+        return None
+
+    try:
+        text = head.decode('utf-8')
+    except UnicodeDecodeError as exc:
+        if exc.start < len(head) - 3:
+            # Not UTF-8, fall back to something that always decodes.
+            text = head.decode('latin-1')
+        else:
+            # Multi-byte character cut off at the end of the read block.
+            text = head[:exc.start].decode('utf-8')
+
+    text = text.lstrip('\ufeff')
+    if text.startswith('#!'):
+        interpreter_line = text[2:].split('\n', 1)[0].split()
+        if interpreter_line and interpreter_line[0].endswith('/env'):
+            interpreter_line = interpreter_line[1:]
+        if not interpreter_line:
+            return None
+        interpreter = interpreter_line[0].rsplit('/', 1)[-1]
+        return SHEBANG_INTERPRETER_MIMETYPES.get(interpreter)
+
+    leading_text = text.lstrip()[:64].lower()
+    if leading_text.startswith('<?xml'):
+        if '<svg' in text:
+            return 'image/svg+xml'
+        return 'application/xml'
+
+    for prefix, mimetype in TEXT_PREFIX_MIMETYPES:
+        if leading_text.startswith(prefix):
+            return mimetype
+
+    for regex, mimetype in TEXT_PATTERN_MIMETYPES:
+        if regex.search(text):
+            return mimetype
+
+    # Generic or unrecognized text, let "file" decide.
+    return None
+
+
+def sniff_file_mimetype(filepath, text_mimetype=None):
+    """
+    Detects the MIME-type of a file from its first 'SNIFF_READ_SIZE' bytes.
+
+    Text without any unambiguous signature is given 'text_mimetype'.
+    Returns None if the file can not be read or the contents are not
+    recognized, in which case something like 'get_file_mimetype()' should be
+    used instead.
+    """
+    try:
+        with open(filepath, 'rb') as filehandle:
+            head = filehandle.read(SNIFF_READ_SIZE)
+    except OSError as exc:
+        LOG.debug('Unable to sniff file %s: %s', filepath, exc)
+        return None
+
+    if not head:
+        return 'inode/x-empty'
+
+    mimetype = sniff_binary_mimetype(head) or sniff_text_mimetype(head)
+    if mimetype is None and not RE_TEXT_CONTROL_CHARACTERS.search(head):
+        return text_mimetype
+    return mimetype
+
 
 def get_file_mimetype(filepath):
     completed_process = subprocess.run(
@@ -435,74 +822,1067 @@ def get_file_mimetype(filepath):
     return mimetype
 
 
+def get_file_mimetypes(filepaths):
+    """
+    Detects the MIME-types of any number of files with a single "file" process.
+
+    The paths are passed on stdin, one per line.  Paths containing newlines
+    can not be passed this way and are instead given as arguments, which
+    "file" examines after those read from stdin.  The output is parsed back
+    in that same order using the NUL-byte that "--print0" places after each
+    (raw) file name, so file names may contain any other characters.
+
+    Returns a list of MIME-types in the same order as the given paths.
+    """
+    encoded_filepaths = [os.fsencode(str(filepath)) for filepath in filepaths]
+    listed_filepaths = [
+        encoded_filepath for encoded_filepath in encoded_filepaths
+        if b'\n' not in encoded_filepath
+    ]
+    argument_filepaths = [
+        encoded_filepath for encoded_filepath in encoded_filepaths
+        if b'\n' in encoded_filepath
+    ]
+
+    completed_process = subprocess.run(
+        ['file', '--mime-type', '--raw', '--print0', '--no-pad', '--files-from', '-', '--']
+        + argument_filepaths,
+        input=b''.join(encoded_filepath + b'\n' for encoded_filepath in listed_filepaths),
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    mimetypes_by_encoded_filepath = parse_file_output(
+        completed_process.stdout, listed_filepaths + argument_filepaths
+    )
+
+    mimetypes = []
+    for filepath, encoded_filepath in zip(filepaths, encoded_filepaths):
+        mimetype = mimetypes_by_encoded_filepath.get(encoded_filepath)
+        if mimetype is None:
+            LOG.warning('Unable to detect MIME-type of file: %s', filepath)
+            mimetype = ''
+        mimetypes.append(mimetype)
+
+    return mimetypes
+
+
+def parse_file_output(output, encoded_filepaths):
+    """
+    Parses the output of "file --mime-type --raw --print0 --no-pad", where
+    each given file name is followed by a NUL-byte, the MIME-type and a
+    newline, in the given order.
+
+    Returns a dict of MIME-types keyed by the encoded file paths.  Parsing
+    stops at the first file name that does not match.
+    """
+    mimetypes_by_encoded_filepath = {}
+    position = 0
+    for encoded_filepath in encoded_filepaths:
+        prefix = encoded_filepath + b'\0'
+        if not output.startswith(prefix, position):
+            break
+
+        start = position + len(prefix)
+        end = output.find(b'\n', start)
+        if end == -1:
+            end = len(output)
+        mimetype = output[start:end].decode('utf-8', errors='replace').lstrip(':').strip()
+        mimetypes_by_encoded_filepath[encoded_filepath] = mimetype
+        position = end + 1
+
+    return mimetypes_by_encoded_filepath
+
+
+def detect_mimetypes_with_file(filepaths):
+    return get_file_mimetypes(filepaths)
+
+
+def detect_mimetypes_with_sniffer(filepaths):
+    return [
+        sniff_file_mimetype(filepath, text_mimetype='text/plain') or 'application/octet-stream'
+        for filepath in filepaths
+    ]
+
+
+def detect_mimetypes_with_sniffer_or_file(filepaths):
+    mimetypes = [sniff_file_mimetype(filepath) for filepath in filepaths]
+
+    unrecognized_indices = [
+        index for index, mimetype in enumerate(mimetypes) if mimetype is None
+    ]
+    if unrecognized_indices:
+        LOG.debug('Falling back to "file" for %d unrecognized file(s)', len(unrecognized_indices))
+        fallback_mimetypes = get_file_mimetypes(
+            [filepaths[index] for index in unrecognized_indices]
+        )
+        for index, mimetype in zip(unrecognized_indices, fallback_mimetypes):
+            mimetypes[index] = mimetype
+
+    return mimetypes
+
+
+# Available MIME-type detection backends, selected with '--detector'.
+# Each one takes a list of paths and returns a list of MIME-types in the
+# same order.
+MIMETYPE_DETECTORS = {
+    'auto': detect_mimetypes_with_sniffer_or_file,
+    'file': detect_mimetypes_with_file,
+    'sniff': detect_mimetypes_with_sniffer,
+}
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def is_ignored_filepath(filepath):
     assert isinstance(filepath, pathlib.Path)
-    return '.git' in filepath.parts or str(filepath.name) == '.gitignore'
+    return (
+        any(is_ignored_dirname(part) for part in filepath.parts)
+        or is_ignored_basename(filepath.name)
+    )
 
 
-def main(options):
-    assert isinstance(options, dict)
+# Messages logged for paths that are skipped before MIME-type detection.
+SKIP_REASON_LOGLEVELS = {
+    'Ignored filepath': logging.DEBUG,
+    'Ignored non-file': logging.DEBUG,
+    'Ignored symbolic link': logging.DEBUG,
+    'Skipped unresolvable file': logging.WARNING,
+}
 
-    logging.basicConfig(
-        format='%(name)s: %(levelname)-8.8s %(message)s',
-        level=options.get('loglevel', logging.INFO),
-    )
+# Result of examining a single path. Skipped paths have a 'skip_reason' from
+# 'SKIP_REASON_LOGLEVELS' and no 'mimetype'. The 'stat' is that of the
+# resolved file and 'cached' is True if the MIME-type came from the cache.
+# Duplicate files are not detected at all and instead have 'duplicate_of'
+# set to the path of the first identical file.  The 'seconds' spent on the
+# file include an even share of the time spent detecting its whole batch.
+DetectedFile = collections.namedtuple(
+    'DetectedFile', ['filepath', 'mimetype', 'skip_reason', 'stat', 'cached', 'duplicate_of', 'seconds']
+)
+
+
+# Only detection results of this form are cached.  For files that it can
+# not read, "file" prints a description like "regular file, no read
+# permission" instead, which must not outlive a change of permissions.
+RE_CACHEABLE_MIMETYPE = re.compile(r'[\w.+-]+/[\w.+-]+\Z', re.ASCII)
+
+
+class MimetypeCache(object):
+    """
+    Persistent SQLite cache of detected MIME-types keyed by the device and
+    inode of files.  Entries are only used if the size, modification time
+    and detector backend still match.  The least recently used entries are
+    evicted on 'close()' to keep at most 'max_entries' entries.  Results
+    that are not MIME-types, like errors, are never cached.
+
+    Lookups happen in worker threads, so all access goes through a lock.
+    """
+    def __init__(self, dbpath, detector, max_entries, rebuild=False):
+        self.detector = detector
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._used_keys = set()
+        self._new_entries = []
+        self._run_timestamp = time.time_ns()
+
+        dbpath.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(dbpath), check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS mimetypes ('
+            ' device INTEGER NOT NULL,'
+            ' inode INTEGER NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' detector TEXT NOT NULL,'
+            ' mimetype TEXT NOT NULL,'
+            ' last_used INTEGER NOT NULL,'
+            ' PRIMARY KEY (device, inode))'
+        )
+        if rebuild:
+            LOG.info('Rebuilding cache %s', dbpath)
+            self._connection.execute('DELETE FROM mimetypes')
+        self._connection.commit()
+
+    def get(self, stat):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime_ns, detector, mimetype FROM mimetypes'
+                ' WHERE device = ? AND inode = ?',
+                (stat.st_dev, stat.st_ino),
+            ).fetchone()
+            if row is None or row[:3] != (stat.st_size, stat.st_mtime_ns, self.detector):
+                return None
+
+            self._used_keys.add((stat.st_dev, stat.st_ino))
+            return row[3]
+
+    def put(self, stat, mimetype):
+        if not mimetype or not RE_CACHEABLE_MIMETYPE.match(mimetype):
+            return
+
+        with self._lock:
+            self._new_entries.append((
+                stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                self.detector, mimetype, self._run_timestamp,
+            ))
+
+    def close(self):
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO mimetypes'
+                ' (device, inode, size, mtime_ns, detector, mimetype, last_used)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self._new_entries,
+            )
+            self._connection.executemany(
+                'UPDATE mimetypes SET last_used = ? WHERE device = ? AND inode = ?',
+                ((self._run_timestamp, device, inode) for device, inode in self._used_keys),
+            )
+
+            (entry_count,) = self._connection.execute('SELECT COUNT(*) FROM mimetypes').fetchone()
+            excess_entry_count = entry_count - self.max_entries
+            if excess_entry_count > 0:
+                LOG.debug('Evicting %d least recently used cache entries', excess_entry_count)
+                self._connection.execute(
+                    'DELETE FROM mimetypes WHERE rowid IN'
+                    ' (SELECT rowid FROM mimetypes ORDER BY last_used ASC LIMIT ?)',
+                    (excess_entry_count,),
+                )
+
+            self._connection.commit()
+            self._connection.close()
+
+
+def get_default_cache_path():
+    cache_dirpath = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return pathlib.Path(cache_dirpath) / _SELF_BASENAME / 'mimetypes.sqlite3'
+
+
+def is_ignored_dirname(dirname):
+    return dirname == '.git'
 
-    for path in options['filepaths']:
+
+def is_ignored_basename(basename):
+    return basename == '.gitignore'
+
+
+def iter_directory_entries(dirpath):
+    """
+    Walks a directory tree depth-first with 'os.scandir()', yielding every
+    entry that is not a directory, in sorted order.  Ignored directories are
+    pruned without descending into them and symbolic links to directories
+    are not followed.  Entries are yielded as they are found, so that huge
+    trees start producing work immediately.
+    """
+    def _sorted_entries(_dirpath):
         try:
-            filepath = pathlib.Path(path).resolve()
-        except FileNotFoundError:
-            LOG.warning('Skipped unresolvable file: %s', path)
+            with os.scandir(_dirpath) as entries:
+                return iter(sorted(entries, key=lambda entry: entry.name))
+        except OSError as exc:
+            LOG.warning('Skipped unreadable directory %s: %s', _dirpath, exc)
+            return iter(())
+
+    pending_entries = [_sorted_entries(dirpath)]
+    while pending_entries:
+        entry = next(pending_entries[-1], None)
+        if entry is None:
+            pending_entries.pop()
             continue
 
-        if not filepath.is_file():
-            LOG.debug('Ignored non-file: %s', filepath)
-            continue
+        try:
+            is_directory = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_directory = False
+
+        if not is_directory:
+            yield entry
+        elif is_ignored_dirname(entry.name):
+            LOG.debug('Pruned ignored directory: %s', entry.path)
+        else:
+            pending_entries.append(_sorted_entries(entry.path))
 
-        if is_ignored_filepath(filepath):
-            LOG.debug('Ignored filepath: %s', filepath)
+
+def iter_paths(paths, recursive=False):
+    for path in paths:
+        if recursive and os.path.isdir(path):
+            dirpath = pathlib.Path(path).resolve()
+            if is_ignored_filepath(dirpath):
+                LOG.debug('Ignored filepath: %s', dirpath)
+                continue
+            yield from iter_directory_entries(dirpath)
+        else:
+            yield path
+
+
+def resolve_directory_entry(entry):
+    filepath = pathlib.Path(entry.path)
+    if entry.is_symlink():
+        return filepath, None, 'Ignored symbolic link'
+
+    if not entry.is_file(follow_symlinks=False):
+        return filepath, None, 'Ignored non-file'
+
+    if is_ignored_basename(entry.name):
+        return filepath, None, 'Ignored filepath'
+
+    try:
+        return filepath, entry.stat(follow_symlinks=False), None
+    except OSError:
+        return filepath, None, 'Ignored non-file'
+
+
+def resolve_candidate_filepath(path, stage_ns=None):
+    """
+    Returns a tuple of the resolved path, its stat result and a skip reason
+    from 'SKIP_REASON_LOGLEVELS' if the path should not be processed.
+    Nanoseconds spent resolving and stat'ing are added to any given
+    'stage_ns' counter.
+    """
+    if isinstance(path, os.DirEntry):
+        # Found when walking a directory, which already resolved the path.
+        start = time.perf_counter_ns()
+        result = resolve_directory_entry(path)
+        if stage_ns is not None:
+            stage_ns['stat'] += time.perf_counter_ns() - start
+        return result
+
+    start = time.perf_counter_ns()
+    try:
+        filepath = pathlib.Path(path).resolve()
+    except FileNotFoundError:
+        return path, None, 'Skipped unresolvable file'
+    finally:
+        resolved = time.perf_counter_ns()
+        if stage_ns is not None:
+            stage_ns['resolve'] += resolved - start
+
+    try:
+        filepath_stat = filepath.stat()
+    except OSError:
+        return filepath, None, 'Ignored non-file'
+    finally:
+        if stage_ns is not None:
+            stage_ns['stat'] += time.perf_counter_ns() - resolved
+
+    if not stat.S_ISREG(filepath_stat.st_mode):
+        return filepath, None, 'Ignored non-file'
+
+    if is_ignored_filepath(filepath):
+        return filepath, None, 'Ignored filepath'
+
+    return filepath, filepath_stat, None
+
+
+class StageProfile(object):
+    """
+    Cumulative time and call counts per processing stage, plus the slowest
+    files.  Worker threads add their counters once per batch, so the lock
+    is only taken once per batch.  Stages timed with 'timed()' and slowest
+    files are only recorded from the main thread and need no lock.
+    """
+    STAGES = ('resolve', 'stat', 'cache', 'detect', 'classify', 'rename', 'output')
+
+    def __init__(self, slowest_count):
+        self.slowest_count = slowest_count
+        self.stage_ns = collections.Counter()
+        self.stage_calls = collections.Counter()
+        self._main_stage_ns = collections.Counter()
+        self._main_stage_calls = collections.Counter()
+        self._slowest_files = []
+        self._lock = threading.Lock()
+
+    def add(self, stage_ns, stage_calls):
+        with self._lock:
+            self.stage_ns.update(stage_ns)
+            self.stage_calls.update(stage_calls)
+
+    @contextlib.contextmanager
+    def timed(self, stage, calls=1):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._main_stage_ns[stage] += time.perf_counter_ns() - start
+            self._main_stage_calls[stage] += calls
+
+    def add_file(self, seconds, filepath):
+        entry = (seconds, str(filepath))
+        if len(self._slowest_files) < self.slowest_count:
+            heapq.heappush(self._slowest_files, entry)
+        elif self._slowest_files and entry > self._slowest_files[0]:
+            heapq.heapreplace(self._slowest_files, entry)
+
+    def format_report(self):
+        self.add(self._main_stage_ns, self._main_stage_calls)
+        self._main_stage_ns.clear()
+        self._main_stage_calls.clear()
+
+        lines = ['{:10s} {:>10s} {:>12s} {:>12s}'.format('Stage', 'Calls', 'Total (s)', 'Mean (ms)')]
+        for stage in self.STAGES:
+            calls = self.stage_calls[stage]
+            if not calls:
+                continue
+            total_seconds = self.stage_ns[stage] / 1e9
+            lines.append('{:10s} {:10d} {:12.3f} {:12.3f}'.format(
+                stage, calls, total_seconds, total_seconds * 1000 / calls
+            ))
+
+        if self._slowest_files:
+            lines.append('')
+            lines.append('Slowest {} file(s):'.format(len(self._slowest_files)))
+            for seconds, filepath in sorted(self._slowest_files, reverse=True):
+                lines.append('{:12.6f} s  {}'.format(seconds, filepath))
+
+        return '\n'.join(lines)
+
+
+class NullStageProfile(object):
+    """
+    Stands in for 'StageProfile' when not profiling, so that stages can be
+    timed unconditionally.
+    """
+    def add(self, stage_ns, stage_calls):
+        pass
+
+    def timed(self, stage, calls=1):
+        return contextlib.nullcontext()
+
+    def add_file(self, seconds, filepath):
+        pass
+
+
+NULL_STAGE_PROFILE = NullStageProfile()
+
+
+def detect_chunk(paths, detect_mimetypes, cache=None, duplicates=None, profile=NULL_STAGE_PROFILE):
+    """
+    Resolves and filters a chunk of paths and detects the MIME-types of any
+    remaining files that are not already in the cache or known duplicates.
+    Called from worker threads, so skipped paths are returned instead of
+    logged to keep the output in input order.
+
+    Returns a list of 'DetectedFile' in the same order as the given paths,
+    skipped paths included so that they can be reported in order.
+    """
+    stage_ns = collections.Counter()
+    stage_calls = collections.Counter()
+    detected_files = []
+    uncached_indices = []
+    for path in paths:
+        start = time.perf_counter_ns()
+        filepath, filepath_stat, skip_reason = resolve_candidate_filepath(path, stage_ns)
+        stage_calls['resolve'] += 1
+        if skip_reason is not None:
+            detected_files.append(DetectedFile(
+                filepath, None, skip_reason, None, False, None, (time.perf_counter_ns() - start) / 1e9
+            ))
             continue
 
-        mimetype = get_file_mimetype(filepath)
-        if mimetype in IGNORED_MIMETYPES:
+        if duplicates and str(filepath) in duplicates:
+            duplicate_of = duplicates[str(filepath)]
+            detected_files.append(DetectedFile(
+                filepath, None, None, filepath_stat, False, duplicate_of, (time.perf_counter_ns() - start) / 1e9
+            ))
             continue
 
-        if mimetype not in MIMETYPE_EXTENSION_LOOKUP:
-            LOG.warning(
-                'Unhandled MIME-type %s from file: %s', mimetype, filepath
+        mimetype = None
+        if cache:
+            cache_start = time.perf_counter_ns()
+            mimetype = cache.get(filepath_stat)
+            stage_ns['cache'] += time.perf_counter_ns() - cache_start
+            stage_calls['cache'] += 1
+
+        if mimetype is None:
+            uncached_indices.append(len(detected_files))
+        detected_files.append(DetectedFile(
+            filepath, mimetype, None, filepath_stat, mimetype is not None, None, (time.perf_counter_ns() - start) / 1e9
+        ))
+
+    if uncached_indices:
+        start = time.perf_counter_ns()
+        mimetypes = detect_mimetypes([detected_files[index].filepath for index in uncached_indices])
+        elapsed_ns = time.perf_counter_ns() - start
+        stage_ns['detect'] += elapsed_ns
+        stage_calls['detect'] += len(uncached_indices)
+
+        seconds_per_file = elapsed_ns / 1e9 / len(uncached_indices)
+        for index, mimetype in zip(uncached_indices, mimetypes):
+            detected_file = detected_files[index]
+            detected_files[index] = detected_file._replace(
+                mimetype=mimetype, seconds=detected_file.seconds + seconds_per_file
             )
-            continue
 
-        truth = MIMETYPE_EXTENSION_LOOKUP[mimetype]
-        if callable(truth):
-            truth = truth(filepath, mimetype)
+    stage_calls['stat'] = stage_calls['resolve']
+    profile.add(stage_ns, stage_calls)
 
-        if truth is USE_AS_IS:
-            LOG.info('Skipping file (use as-is): %s', filepath)
-            continue
+    return detected_files
 
-        if isinstance(truth, str):
-            extension = truth
-        else:
-            LOG.error('Unhandled truth %r (MIME-type %s) from file: %s', truth, mimetype, filepath)
-            continue
 
-        if not extension:
-            LOG.error('Got None truth (MIME-type %s) from file: %s', mimetype, filepath)
+def hash_file_partially(filepath, size):
+    # Hashes the first and last blocks, which is all of any small file.
+    digest = hashlib.blake2b()
+    with open(filepath, 'rb') as filehandle:
+        digest.update(filehandle.read(PARTIAL_HASH_BLOCK_SIZE))
+        if size > PARTIAL_HASH_BLOCK_SIZE:
+            filehandle.seek(max(PARTIAL_HASH_BLOCK_SIZE, size - PARTIAL_HASH_BLOCK_SIZE))
+            digest.update(filehandle.read(PARTIAL_HASH_BLOCK_SIZE))
+    return digest.digest()
+
+
+def hash_file(filepath):
+    digest = hashlib.blake2b()
+    with open(filepath, 'rb') as filehandle:
+        for block in iter(lambda: filehandle.read(FULL_HASH_READ_SIZE), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _split_by_key(files, key_function):
+    groups = collections.OrderedDict()
+    for filepath, filepath_stat in files:
+        try:
+            key = key_function(filepath, filepath_stat)
+        except OSError as exc:
+            LOG.warning('Unable to read file %s: %s', filepath, exc)
+            continue
+        groups.setdefault(key, []).append((filepath, filepath_stat))
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicate_files(files):
+    """
+    Finds files with identical contents among a list of tuples of paths and
+    stat results, in input order.  A path given more than once is only
+    considered the first time, so no file is ever a duplicate of itself.
+
+    Files are first grouped by size, which settles most files without
+    reading them.  Files sharing an inode are trivially identical.  Other
+    candidates are compared by a hash of their first and last blocks and
+    only files that still match are hashed in full.
+
+    Returns a dict mapping the string paths of duplicates to the path of the
+    first file with the same contents.
+    """
+    duplicates = {}
+
+    def _add_duplicates(group):
+        canonical_filepath = group[0][0]
+        for filepath, _ in group[1:]:
+            duplicates[str(filepath)] = canonical_filepath
+
+    seen_paths = set()
+    files_by_size = collections.OrderedDict()
+    for filepath, filepath_stat in files:
+        if str(filepath) in seen_paths:
             continue
+        seen_paths.add(str(filepath))
+        if filepath_stat.st_size > 0:
+            files_by_size.setdefault(filepath_stat.st_size, []).append((filepath, filepath_stat))
 
-        if filepath.suffix[1:] == extension:
-            LOG.info('Skipping file (final extension OK): %s', filepath)
+    for size, same_size_files in files_by_size.items():
+        if len(same_size_files) < 2:
             continue
 
-        current_compound_suffixes = ''.join(filepath.suffixes).lstrip('.')
-        if current_compound_suffixes == extension:
-            LOG.info('Skipping file (compound extension OK) %s', filepath)
+        distinct_inode_files = []
+        for group in _split_by_key(same_size_files, lambda _, st: (st.st_dev, st.st_ino)):
+            _add_duplicates(group)
+        for filepath, filepath_stat in same_size_files:
+            if str(filepath) not in duplicates:
+                distinct_inode_files.append((filepath, filepath_stat))
+
+        for group in _split_by_key(distinct_inode_files, lambda fp, _: hash_file_partially(fp, size)):
+            if size <= 2 * PARTIAL_HASH_BLOCK_SIZE:
+                _add_duplicates(group)
+                continue
+
+            for identical_group in _split_by_key(group, lambda fp, _: hash_file(fp)):
+                _add_duplicates(identical_group)
+
+    return duplicates
+
+
+def hardlink_duplicate(canonical_filepath, duplicate_filepath):
+    # Link to a temporary name first so that the duplicate is replaced
+    # atomically and never goes missing.
+    temporary_path = os.path.join(
+        os.path.dirname(duplicate_filepath),
+        '.{}.{}.tmp'.format(os.path.basename(duplicate_filepath), _SELF_BASENAME),
+    )
+    os.link(canonical_filepath, temporary_path)
+    try:
+        os.replace(temporary_path, duplicate_filepath)
+    except OSError:
+        os.remove(temporary_path)
+        raise
+
+
+def deduplicate_paths(paths, jobs, hardlink=False):
+    """
+    Resolves all paths up front and finds duplicate files among them,
+    optionally replacing duplicates with hard links to the first identical
+    file.  Returns a dict of duplicates like 'find_duplicate_files()'.
+    """
+    def _resolve_chunk(chunk):
+        return [resolve_candidate_filepath(path) for path in chunk]
+
+    files = []
+    for resolved_paths in iter_ordered_results(_resolve_chunk, iter_chunks(paths, DEFAULT_BATCH_SIZE), jobs):
+        for filepath, filepath_stat, skip_reason in resolved_paths:
+            if skip_reason is None:
+                files.append((filepath, filepath_stat))
+
+    duplicates = find_duplicate_files(files)
+    LOG.info('Found %d duplicate(s) among %d file(s)', len(duplicates), len(files))
+
+    if hardlink:
+        files_by_path = {str(filepath): filepath_stat for filepath, filepath_stat in files}
+        for duplicate_path, canonical_filepath in duplicates.items():
+            canonical_stat = files_by_path[str(canonical_filepath)]
+            duplicate_stat = files_by_path[duplicate_path]
+            if (duplicate_stat.st_dev, duplicate_stat.st_ino) == (canonical_stat.st_dev, canonical_stat.st_ino):
+                continue
+            if duplicate_stat.st_dev != canonical_stat.st_dev:
+                LOG.warning('Unable to hardlink across devices: %s', duplicate_path)
+                continue
+
+            try:
+                hardlink_duplicate(str(canonical_filepath), duplicate_path)
+            except OSError as exc:
+                LOG.error('Unable to hardlink %s: %s', duplicate_path, exc)
+                continue
+            LOG.info('Hardlinked duplicate: %s -> %s', duplicate_path, canonical_filepath)
+
+    return duplicates
+
+
+def iter_ordered_results(function, chunks, jobs):
+    """
+    Like 'Executor.map()' but only keeps 'jobs * 2' chunks in flight, so that
+    memory use stays flat no matter how many chunks there are.
+    """
+    if jobs <= 1:
+        for chunk in chunks:
+            yield function(chunk)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending_futures = collections.deque()
+        for chunk in chunks:
+            pending_futures.append(executor.submit(function, chunk))
+            if len(pending_futures) >= jobs * 2:
+                yield pending_futures.popleft().result()
+
+        while pending_futures:
+            yield pending_futures.popleft().result()
+
+
+# Outcomes of 'decide_extension()' with the level and message they are logged
+# with.  Messages are formatted with a dict of 'filepath', 'mimetype' and
+# 'extension'.
+DECISION_LOG_MESSAGES = {
+    'compound-extension-ok': (logging.INFO, 'Skipping file (compound extension OK) %(filepath)s'),
+    'extension-ok': (logging.INFO, 'Skipping file (final extension OK): %(filepath)s'),
+    'ignored-mimetype': (logging.DEBUG, 'Ignored MIME-type %(mimetype)s from file: %(filepath)s'),
+    'no-extension': (logging.ERROR, 'Got no extension (MIME-type %(mimetype)s) from file: %(filepath)s'),
+    'rename': (logging.DEBUG, 'Extension %(extension)s needed (MIME-type %(mimetype)s) for file: %(filepath)s'),
+    'unhandled-mimetype': (logging.WARNING, 'Unhandled MIME-type %(mimetype)s from file: %(filepath)s'),
+    'use-as-is': (logging.INFO, 'Skipping file (use as-is): %(filepath)s'),
+}
+
+
+def decide_extension(filepath, mimetype, compiled_rules=COMPILED_MIMETYPE_RULES):
+    """
+    Returns a tuple of a decision from 'DECISION_LOG_MESSAGES' and the
+    extension to add, which is None unless the decision is 'rename'.
+    """
+    if mimetype in IGNORED_MIMETYPES:
+        return 'ignored-mimetype', None
+
+    compiled_rule = compiled_rules.get(mimetype)
+    if compiled_rule is None:
+        return 'unhandled-mimetype', None
+
+    extension = classify_basename(filepath.name, compiled_rule)
+    if extension is USE_AS_IS:
+        return 'use-as-is', None
+
+    if not extension:
+        return 'no-extension', None
+
+    if filepath.suffix[1:] == extension:
+        return 'extension-ok', None
+
+    current_compound_suffixes = ''.join(filepath.suffixes).lstrip('.')
+    if current_compound_suffixes == extension:
+        return 'compound-extension-ok', None
+
+    return 'rename', extension
+
+
+class JsonLinesWriter(object):
+    """
+    Writes records as JSON lines to a text stream.  Lines are buffered and
+    only written and flushed in blocks, by 'flush()' or once 'block_size'
+    lines are buffered.
+    """
+    def __init__(self, stream, block_size=DEFAULT_BATCH_SIZE):
+        self.stream = stream
+        self.block_size = block_size
+        self._lines = []
+
+    def write(self, record):
+        self._lines.append(json.dumps(record))
+        if len(self._lines) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self.stream.write('\n'.join(self._lines))
+            self._lines = []
+        self.stream.flush()
+
+
+def get_default_journal_path():
+    return get_default_cache_path().with_name('rename-journal.jsonl')
+
+
+def fsync_directory(dirpath):
+    try:
+        directory_fd = os.open(dirpath, os.O_RDONLY)
+    except OSError as exc:
+        LOG.debug('Unable to open directory %s for syncing: %s', dirpath, exc)
+        return
+
+    try:
+        os.fsync(directory_fd)
+    except OSError as exc:
+        LOG.debug('Unable to sync directory %s: %s', dirpath, exc)
+    finally:
+        os.close(directory_fd)
+
+
+def rename_without_replacing(source_path, destination_path):
+    # Not atomic, but 'os.link()' based alternatives are not supported by
+    # all of the file systems that this is used on.
+    if os.path.lexists(destination_path):
+        raise FileExistsError(errno.EEXIST, 'Destination exists', destination_path)
+    os.rename(source_path, destination_path)
+
+
+class RenameJournal(object):
+    """
+    Performs renames through a write-ahead journal of JSON lines.
+
+    Renames are queued per directory and performed in batches, one batch per
+    directory, whenever 'batch_size' renames are pending in total.  Before a
+    batch is performed, a "begin" record listing all of its renames is
+    written and synced to the journal.  After the renames, the directory is
+    synced once and a "commit" record is written.  A crash or interrupt thus
+    leaves at most the batches without a "commit" record half-done, which
+    'resume_journal()' completes and 'rollback_journal()' reverts.
+
+    The journal file is removed by 'close()' once all batches are committed.
+    """
+    def __init__(self, journal_path, batch_size):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.renamed_count = 0
+        self._pending_renames = collections.OrderedDict()
+        self._pending_count = 0
+
+        journal_path.parent.mkdir(parents=True, exist_ok=True)
+        self._filehandle = open(journal_path, 'x', encoding='utf8')
+
+    def add(self, source_path, destination_path):
+        dirpath = os.path.dirname(source_path)
+        self._pending_renames.setdefault(dirpath, []).append((source_path, destination_path))
+        self._pending_count += 1
+        if self._pending_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self._pending_count = 0
+        while self._pending_renames:
+            dirpath, renames = self._pending_renames.popitem(last=False)
+            self._perform_batch(dirpath, renames)
+
+    def close(self):
+        self.flush()
+        self._filehandle.close()
+        os.remove(self.journal_path)
+
+    def _write_record(self, record, sync):
+        self._filehandle.write(json.dumps(record) + '\n')
+        self._filehandle.flush()
+        if sync:
+            os.fsync(self._filehandle.fileno())
+
+    def _perform_batch(self, dirpath, renames):
+        self._write_record({'op': 'begin', 'dirpath': dirpath, 'renames': renames}, sync=True)
+
+        for source_path, destination_path in renames:
+            try:
+                rename_without_replacing(source_path, destination_path)
+            except OSError as exc:
+                LOG.error('Unable to rename %s: %s', source_path, exc)
+                continue
+            LOG.info('Renamed: %s -> %s', source_path, destination_path)
+            self.renamed_count += 1
+
+        fsync_directory(dirpath)
+        # A lost "commit" record only means that an already completed batch
+        # is completed again on resume, which is a no-op.
+        self._write_record({'op': 'commit', 'dirpath': dirpath}, sync=False)
+
+
+def read_journal_batches(journal_path):
+    """
+    Returns a list of all batches in the journal as tuples of the directory
+    path, the list of renames and whether the batch was committed.
+    """
+    batches = []
+    uncommitted_indices = {}
+    with open(journal_path, 'r', encoding='utf8') as filehandle:
+        for line in filehandle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Most likely a partially written last line.
+                LOG.warning('Ignoring corrupt journal record: %r', line)
+                continue
+
+            if record['op'] == 'begin':
+                uncommitted_indices[record['dirpath']] = len(batches)
+                batches.append((record['dirpath'], record['renames'], False))
+            elif record['op'] == 'commit':
+                index = uncommitted_indices.pop(record['dirpath'], None)
+                if index is not None:
+                    dirpath, renames, _ = batches[index]
+                    batches[index] = (dirpath, renames, True)
+
+    return batches
+
+
+def resume_journal(journal_path):
+    for dirpath, renames, committed in read_journal_batches(journal_path):
+        if committed:
             continue
 
-        LOG.info('Would have renamed: %s (%s) (extension=%s)', filepath, mimetype, extension)
+        LOG.info('Resuming %d rename(s) in directory: %s', len(renames), dirpath)
+        for source_path, destination_path in renames:
+            if os.path.lexists(source_path) and not os.path.lexists(destination_path):
+                os.rename(source_path, destination_path)
+                LOG.info('Renamed: %s -> %s', source_path, destination_path)
+        fsync_directory(dirpath)
+
+    os.remove(journal_path)
+
+
+def rollback_journal(journal_path):
+    for dirpath, renames, _ in reversed(read_journal_batches(journal_path)):
+        LOG.info('Rolling back %d rename(s) in directory: %s', len(renames), dirpath)
+        for source_path, destination_path in reversed(renames):
+            if os.path.lexists(destination_path) and not os.path.lexists(source_path):
+                os.rename(destination_path, source_path)
+                LOG.info('Renamed back: %s -> %s', destination_path, source_path)
+        fsync_directory(dirpath)
+
+    os.remove(journal_path)
+
 
-    return True
+def main(options):
+    assert isinstance(options, dict)
+
+    logging.basicConfig(
+        format='%(name)s: %(levelname)-8.8s %(message)s',
+        level=options.get('loglevel', logging.INFO),
+    )
+
+    journal_path = options.get('journal_path') or get_default_journal_path()
+    if options.get('rollback'):
+        if not journal_path.exists():
+            LOG.critical('No journal to roll back: %s', journal_path)
+            return 1
+        rollback_journal(journal_path)
+        return 0
+
+    if options.get('resume'):
+        if journal_path.exists():
+            resume_journal(journal_path)
+        else:
+            LOG.warning('No journal to resume: %s', journal_path)
+    elif options.get('apply') and journal_path.exists():
+        LOG.critical(
+            'Found journal of an interrupted run, use --resume or --rollback: %s',
+            journal_path
+        )
+        return 1
+
+    compiled_rules = COMPILED_MIMETYPE_RULES
+    if options.get('rules_filepaths'):
+        rules = dict(MIMETYPE_RULES)
+        for rules_filepath in options['rules_filepaths']:
+            try:
+                rules.update(load_mimetype_rules(rules_filepath))
+            except (OSError, ValueError) as exc:
+                LOG.critical('Unable to load rules from %s: %s', rules_filepath, exc)
+                return 1
+        try:
+            compiled_rules = compile_mimetype_rules(rules)
+        except (AttributeError, TypeError, ValueError) as exc:
+            LOG.critical('Invalid rules: %s', exc)
+            return 1
+
+    detect_mimetypes = MIMETYPE_DETECTORS[options.get('detector', 'auto')]
+    batch_size = options.get('batch_size', DEFAULT_BATCH_SIZE)
+
+    jobs = options.get('jobs') or DEFAULT_JOBS
+    if options.get('profile_output') and jobs > 1:
+        # cProfile only sees the thread it is enabled in, so detect in the
+        # main thread for the statistics to include all stages.
+        LOG.info('Using a single job to profile with cProfile')
+        jobs = 1
+
+    cache = None
+    if options.get('cache', True):
+        cache_path = options.get('cache_path') or get_default_cache_path()
+        try:
+            cache = MimetypeCache(
+                cache_path,
+                detector=options.get('detector', 'auto'),
+                max_entries=options.get('cache_max_entries', DEFAULT_CACHE_MAX_ENTRIES),
+                rebuild=options.get('rebuild_cache', False),
+            )
+        except (OSError, sqlite3.Error) as exc:
+            LOG.warning('Not using cache %s: %s', cache_path, exc)
+
+    paths = iter_paths(options['filepaths'], options.get('recursive', False))
+
+    duplicates = None
+    if options.get('dedup'):
+        # Grouping by size needs every file up front.
+        paths = list(paths)
+        hardlink = options['dedup'] == 'hardlink' and options.get('apply')
+        duplicates = deduplicate_paths(paths, jobs, hardlink=hardlink)
+    canonical_mimetypes = {}
+
+    profile = NULL_STAGE_PROFILE
+    if options.get('profile'):
+        profile = StageProfile(options.get('profile_top', DEFAULT_PROFILE_TOP))
+
+    def _detect_chunk(_paths):
+        return detect_chunk(_paths, detect_mimetypes, cache, duplicates, profile)
+
+    journal = None
+    if options.get('apply'):
+        journal = RenameJournal(journal_path, batch_size)
+
+    writer = None
+    if options.get('output_format') == 'jsonl':
+        writer = JsonLinesWriter(sys.stdout, batch_size)
+
+    profiler = None
+    if options.get('profile_output'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    summary = collections.Counter()
+    chunks = iter_chunks(paths, batch_size)
+    try:
+        for detected_files in iter_ordered_results(_detect_chunk, chunks, jobs):
+            for detected_file in detected_files:
+                filepath = detected_file.filepath
+                if detected_file.skip_reason:
+                    summary['skipped'] += 1
+                    loglevel = SKIP_REASON_LOGLEVELS[detected_file.skip_reason]
+                    LOG.log(loglevel, '%s: %s', detected_file.skip_reason, filepath)
+                    if writer:
+                        writer.write({
+                            'path': str(filepath),
+                            'decision': 'skipped',
+                            'skip_reason': detected_file.skip_reason,
+                            'seconds': detected_file.seconds,
+                        })
+                    continue
+
+                if detected_file.duplicate_of:
+                    summary['duplicates'] += 1
+                    LOG.info('Duplicate of %s: %s', detected_file.duplicate_of, filepath)
+                    mimetype = canonical_mimetypes[str(detected_file.duplicate_of)]
+                else:
+                    summary['detected'] += 1
+                    mimetype = detected_file.mimetype
+                    if cache:
+                        if detected_file.cached:
+                            summary['cache hits'] += 1
+                        else:
+                            summary['cache misses'] += 1
+                            cache.put(detected_file.stat, mimetype)
+                    if duplicates:
+                        canonical_mimetypes[str(filepath)] = mimetype
+
+                with profile.timed('classify'):
+                    decision, extension = decide_extension(filepath, mimetype, compiled_rules)
+                profile.add_file(detected_file.seconds, filepath)
+                summary[decision] += 1
+                loglevel, message = DECISION_LOG_MESSAGES[decision]
+                LOG.log(loglevel, message, {'filepath': filepath, 'mimetype': mimetype, 'extension': extension})
+
+                destination_path = None
+                if decision == 'rename':
+                    destination_path = '{}.{}'.format(filepath, extension)
+                    if journal:
+                        with profile.timed('rename'):
+                            journal.add(str(filepath), destination_path)
+                    else:
+                        LOG.info('Would have renamed: %s -> %s', filepath, destination_path)
+
+                if writer:
+                    with profile.timed('output'):
+                        writer.write({
+                            'path': str(filepath),
+                            'mimetype': mimetype,
+                            'decision': decision,
+                            'extension': extension,
+                            'destination': destination_path,
+                            'cached': detected_file.cached,
+                            'duplicate_of': str(detected_file.duplicate_of) if detected_file.duplicate_of else None,
+                            'seconds': detected_file.seconds,
+                        })
+
+            if writer:
+                with profile.timed('output', calls=0):
+                    writer.flush()
+
+        if journal:
+            with profile.timed('rename', calls=0):
+                journal.close()
+            summary['renamed'] = journal.renamed_count
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(options['profile_output'])
+            LOG.info('Wrote cProfile statistics to %s', options['profile_output'])
+        if cache:
+            cache.close()
+
+    if options.get('profile'):
+        print(profile.format_report(), file=sys.stderr)
+
+    LOG.info('Summary: %s', ', '.join(
+        '{} {}'.format(count, name) for name, count in sorted(summary.items())
+    ))
+
+    return 0
 
 
 def parse_args():
@@ -514,9 +1894,172 @@ def parse_args():
     parser.add_argument(
         'filepaths',
         help='files to process.',
-        nargs='+',
+        nargs='*',
         type=str,
     )
+    parser.add_argument(
+        '--apply',
+        action='store_true',
+        default=False,
+        dest='apply',
+        help='Actually rename files by adding extensions. Renames are'
+             ' recorded in a journal first, see "--resume" and "--rollback".'
+             ' Default is to only log what would have been renamed.',
+    )
+    parser.add_argument(
+        '--journal',
+        default=None,
+        dest='journal_path',
+        metavar='PATH',
+        type=pathlib.Path,
+        help='Journal file used by "--apply". Removed after a complete run.'
+             ' Default: {}'.format(get_default_journal_path()),
+    )
+    journal_action_group = parser.add_mutually_exclusive_group()
+    journal_action_group.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        dest='resume',
+        help='Complete the renames of an interrupted run from its journal'
+             ' before processing any given files.',
+    )
+    journal_action_group.add_argument(
+        '--rollback',
+        action='store_true',
+        default=False,
+        dest='rollback',
+        help='Revert all renames of an interrupted run from its journal and'
+             ' exit.',
+    )
+    parser.add_argument(
+        '--dedup',
+        choices=('report', 'hardlink'),
+        default=None,
+        dest='dedup',
+        help='Find files with identical contents before detecting MIME-types.'
+             ' Duplicates reuse the MIME-type of the first identical file.'
+             ' "report" logs them and "hardlink" also replaces them with hard'
+             ' links to the first identical file when used with "--apply".'
+             ' Needs all paths up front, so output only starts once every'
+             ' path has been found.',
+    )
+    parser.add_argument(
+        '--format',
+        choices=('text', 'jsonl'),
+        default='text',
+        dest='output_format',
+        help='"text" only logs results. "jsonl" also writes one JSON object'
+             ' per file to stdout as results are produced, with the path,'
+             ' MIME-type, decision, extension to add and seconds spent.'
+             ' Default: %(default)s',
+    )
+    parser.add_argument(
+        '--rules',
+        action='append',
+        default=[],
+        dest='rules_filepaths',
+        metavar='PATH',
+        help='JSON file with additional rules for picking extensions by'
+             ' MIME-type, in the format of "MIMETYPE_RULES". Replaces the'
+             ' built-in rules for any MIME-types it contains.'
+             ' Repeat to load several files.',
+    )
+    parser.add_argument(
+        '-r', '--recursive',
+        action='store_true',
+        default=False,
+        dest='recursive',
+        help='Process all files in any given directories, recursively.'
+             ' Ignored directories like ".git" are skipped entirely and'
+             ' symbolic links are not followed.',
+    )
+    parser.add_argument(
+        '--detector',
+        choices=sorted(MIMETYPE_DETECTORS),
+        default='auto',
+        dest='detector',
+        help='MIME-type detection backend. "sniff" reads the first few KB of'
+             ' each file in-process, "file" runs the "file" command once per'
+             ' batch of files and "auto" sniffs and falls back to "file" for'
+             ' anything unrecognized. Default: %(default)s',
+    )
+    parser.add_argument(
+        '--batch-size',
+        default=DEFAULT_BATCH_SIZE,
+        dest='batch_size',
+        metavar='N',
+        type=int,
+        help='Number of files detected together, I.E. passed to each'
+             ' "file" process. Default: %(default)s',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        default=DEFAULT_JOBS,
+        dest='jobs',
+        metavar='N',
+        type=int,
+        help='Number of batches of files detected concurrently.'
+             ' Results are still reported in input order.'
+             ' Default: %(default)s (number of CPUs)',
+    )
+    parser.add_argument(
+        '--cache-path',
+        default=None,
+        dest='cache_path',
+        metavar='PATH',
+        type=pathlib.Path,
+        help='SQLite database used to cache detected MIME-types between runs.'
+             ' Default: {}'.format(get_default_cache_path()),
+    )
+    parser.add_argument(
+        '--cache-max-entries',
+        default=DEFAULT_CACHE_MAX_ENTRIES,
+        dest='cache_max_entries',
+        metavar='N',
+        type=int,
+        help='Evict the least recently used cache entries beyond N entries.'
+             ' Default: %(default)s',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_false',
+        default=True,
+        dest='cache',
+        help='Do not read or update the MIME-type cache.',
+    )
+    parser.add_argument(
+        '--rebuild-cache',
+        action='store_true',
+        default=False,
+        dest='rebuild_cache',
+        help='Discard all cached MIME-types and detect every file again.',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        dest='profile',
+        help='Print time spent per stage and the slowest files to stderr'
+             ' at exit.',
+    )
+    parser.add_argument(
+        '--profile-top',
+        default=DEFAULT_PROFILE_TOP,
+        dest='profile_top',
+        metavar='N',
+        type=int,
+        help='Number of slowest files listed by --profile.'
+             ' Default: %(default)s',
+    )
+    parser.add_argument(
+        '--profile-output',
+        default=None,
+        dest='profile_output',
+        metavar='PATH',
+        help='Write cProfile statistics to PATH, for use with'
+             ' "python3 -m pstats PATH". Implies "--jobs 1".',
+    )
     parser.add_argument(
         '-v', '--verbose',
         action='count',
@@ -534,12 +2077,42 @@ def parse_args():
         3: logging.DEBUG,
     }.get(min(args.verbosity_level, 3), logging.ERROR)
 
-    if not args.filepaths:
+    if not args.filepaths and not (args.resume or args.rollback):
         parser.error('Argument filepaths must be one or more files')
 
+    if args.batch_size < 1:
+        parser.error('Argument --batch-size must be a positive integer')
+
+    if args.jobs < 1:
+        parser.error('Argument --jobs must be a positive integer')
+
+    if args.cache_max_entries < 1:
+        parser.error('Argument --cache-max-entries must be a positive integer')
+
+    if args.profile_top < 0:
+        parser.error('Argument --profile-top must be zero or a positive integer')
+
     return {
+        'apply': args.apply,
+        'batch_size': args.batch_size,
+        'cache': args.cache,
+        'cache_max_entries': args.cache_max_entries,
+        'cache_path': args.cache_path,
+        'dedup': args.dedup,
+        'detector': args.detector,
         'filepaths': args.filepaths,
+        'jobs': args.jobs,
+        'journal_path': args.journal_path,
         'loglevel': loglevel,
+        'output_format': args.output_format,
+        'profile': args.profile,
+        'profile_output': args.profile_output,
+        'profile_top': args.profile_top,
+        'rebuild_cache': args.rebuild_cache,
+        'recursive': args.recursive,
+        'resume': args.resume,
+        'rollback': args.rollback,
+        'rules_filepaths': args.rules_filepaths,
     }
 
 
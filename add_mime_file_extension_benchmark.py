@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Benchmarks for 'add_mime_file_extension.py' using synthetic files.
+# Run with "python3 add_mime_file_extension_benchmark.py [--count N]".
+
+import argparse
+import io
+import pathlib
+import random
+import struct
+import tempfile
+import time
+import zipfile
+
+import add_mime_file_extension
+
+
+def _zip_bytes(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in members:
+            compression = zipfile.ZIP_STORED if name == 'mimetype' else zipfile.ZIP_DEFLATED
+            archive.writestr(name, data, compress_type=compression)
+    return buffer.getvalue()
+
+
+def _cdf_bytes(stream_name):
+    header = bytearray(512)
+    header[:8] = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+    struct.pack_into('<H', header, 30, 9)
+    struct.pack_into('<i', header, 48, 0)
+    directory = bytearray(512)
+    for index, name in enumerate(('Root Entry', stream_name)):
+        encoded_name = name.encode('utf-16-le') + b'\x00\x00'
+        directory[index * 128:index * 128 + len(encoded_name)] = encoded_name
+        struct.pack_into('<H', directory, index * 128 + 64, len(encoded_name))
+    return bytes(header + directory)
+
+
+SAMPLE_FILE_CONTENTS = {
+    'sample.7z': b'7z\xbc\xaf\x27\x1c' + bytes(64),
+    'sample.avi': b'RIFF\x00\x00\x00\x00AVI LIST' + bytes(64),
+    'sample.bmp': b'BM\x36\x00\x00\x00\x00\x00\x00\x00\x36\x00' + bytes(64),
+    'sample.c': b'#include <stdio.h>\n\nint main(void)\n{\n    return 0;\n}\n',
+    'sample.cpp': b'#include <vector>\n\nnamespace foo {\nclass Bar {};\n}\n',
+    'sample.doc': _cdf_bytes('WordDocument'),
+    'sample.docx': _zip_bytes([('[Content_Types].xml', b'<Types/>'), ('word/document.xml', b'<w/>')]),
+    'sample.eml': b'Return-Path: <foo@example.com>\nSubject: Hello\n\nBody\n',
+    'sample.flac': b'fLaC\x00\x00\x00\x22' + bytes(64),
+    'sample.gif': b'GIF89a' + bytes(64),
+    'sample.gz': b'\x1f\x8b\x08\x00' + bytes(64),
+    'sample.html': b'<!DOCTYPE html>\n<html><body>Hello</body></html>\n',
+    'sample.jar': _zip_bytes([('META-INF/MANIFEST.MF', b'Manifest-Version: 1.0\n')]),
+    'sample.jpg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + bytes(64),
+    'sample.mp3': b'ID3\x03\x00\x00\x00\x00\x00\x00' + bytes(64),
+    'sample.mp4': b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2' + bytes(64),
+    'sample.odt': _zip_bytes([('mimetype', b'application/vnd.oasis.opendocument.text'), ('content.xml', b'<x/>')]),
+    'sample.pdf': b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n' + bytes(64),
+    'sample.png': b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + bytes(64),
+    'sample.py': b'#!/usr/bin/env python3\n\nimport sys\n\nprint(sys.argv)\n',
+    'sample.rtf': b'{\\rtf1\\ansi Hello}\n',
+    'sample.sh': b'#!/bin/bash\n\necho hello\n',
+    'sample.svg': b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg"/>\n',
+    'sample.tar': bytes(257) + b'ustar\x0000' + bytes(250),
+    'sample.txt': b'Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' * 20,
+    'sample.wav': b'RIFF\x00\x00\x00\x00WAVEfmt ' + bytes(64),
+    'sample.xml': b'<?xml version="1.0"?>\n<root><child/></root>\n',
+    'sample.zip': _zip_bytes([('foo.txt', b'foo')]),
+}
+
+
+def create_synthetic_tree(dirpath, count):
+    samples = sorted(SAMPLE_FILE_CONTENTS.items())
+    filepaths = []
+    for index in range(count):
+        basename, content = samples[index % len(samples)]
+        subdirpath = dirpath / 'dir{:03d}'.format(index // 100)
+        subdirpath.mkdir(exist_ok=True)
+        filepath = subdirpath / '{:06d}_{}'.format(index, basename)
+        filepath.write_bytes(content)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def _detect_mimetypes_one_file_process_per_path(filepaths):
+    return [add_mime_file_extension.get_file_mimetype(filepath) for filepath in filepaths]
+
+
+def _print_result(name, count, elapsed):
+    print('{:12s} {:8d} files {:8.3f} s {:12.1f} files/s'.format(
+        name, count, elapsed, count / elapsed
+    ))
+
+
+def benchmark_detectors(filepaths, batch_size):
+    detectors = dict(add_mime_file_extension.MIMETYPE_DETECTORS)
+    detectors['file-per-path'] = _detect_mimetypes_one_file_process_per_path
+
+    results = {}
+    for detector_name in ('file-per-path', 'file', 'sniff', 'auto'):
+        detect_mimetypes = detectors[detector_name]
+        start = time.perf_counter()
+        results[detector_name] = []
+        for chunk in add_mime_file_extension.iter_chunks(filepaths, batch_size):
+            results[detector_name].extend(detect_mimetypes(chunk))
+        _print_result(detector_name, len(filepaths), time.perf_counter() - start)
+
+    assert results['file-per-path'] == results['file']
+
+    for detector_name in ('sniff', 'auto'):
+        disagreements = sum(
+            1 for file_result, result in zip(results['file'], results[detector_name])
+            if file_result != result
+        )
+        print('Backends "file" and "{}" disagree on {} of {} files'.format(
+            detector_name, disagreements, len(filepaths)
+        ))
+
+
+def create_synthetic_classification_pairs(count):
+    rng = random.Random(0)
+    mimetypes = sorted(add_mime_file_extension.MIMETYPE_RULES)
+    stems = ['README', 'notes', '.bashrc', 'photo', 'archive', 'config.h', 'pkg']
+    extensions = ['', '.txt', '.md', '.in', '.cmakein', '.jpg', '.py', '.tar.gz', '.xml', '.bin']
+    return [
+        (rng.choice(stems) + rng.choice(extensions), rng.choice(mimetypes))
+        for _ in range(count)
+    ]
+
+
+def benchmark_classification(pairs):
+    compiled_rules = add_mime_file_extension.COMPILED_MIMETYPE_RULES
+    classify_basename = add_mime_file_extension.classify_basename
+
+    start = time.perf_counter()
+    for basename, mimetype in pairs:
+        classify_basename(basename, compiled_rules[mimetype])
+    elapsed = time.perf_counter() - start
+    print('{:12s} {:8d} pairs {:8.3f} s {:12.1f} pairs/s'.format(
+        'classify', len(pairs), elapsed, len(pairs) / elapsed
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks MIME-type detection.')
+    parser.add_argument('--count', default=2000, type=int, help='Number of synthetic files.')
+    parser.add_argument('--batch-size', default=add_mime_file_extension.DEFAULT_BATCH_SIZE, type=int)
+    parser.add_argument('--pairs', default=2000000, type=int, help='Number of (name, MIME-type) pairs to classify.')
+    args = parser.parse_args()
+
+    benchmark_classification(create_synthetic_classification_pairs(args.pairs))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepaths = create_synthetic_tree(pathlib.Path(tempdir), args.count)
+        benchmark_detectors(filepaths, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
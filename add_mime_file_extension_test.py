@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import logging
+import os
+import pathlib
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest import mock
+from unittest import skipIf
+
+import add_mime_file_extension
+from add_mime_file_extension import JsonLinesWriter
+from add_mime_file_extension import MIMETYPE_RULES
+from add_mime_file_extension import MimetypeCache
+from add_mime_file_extension import RenameJournal
+from add_mime_file_extension import compile_basename_endings
+from add_mime_file_extension import deduplicate_paths
+from add_mime_file_extension import find_duplicate_files
+from add_mime_file_extension import get_extension
+from add_mime_file_extension import get_file_mimetypes
+from add_mime_file_extension import iter_ordered_results
+from add_mime_file_extension import iter_paths
+from add_mime_file_extension import main
+from add_mime_file_extension import match_basename_ending
+from add_mime_file_extension import parse_file_output
+from add_mime_file_extension import resolve_directory_entry
+from add_mime_file_extension import resume_journal
+from add_mime_file_extension import rollback_journal
+from add_mime_file_extension import sniff_file_mimetype
+from add_mime_file_extension import sniff_text_mimetype
+
+
+class TestSniffTextMimetype(TestCase):
+    def test_unambiguous_signatures(self):
+        self.assertEqual(sniff_text_mimetype(b'#!/usr/bin/env python3\nprint(1)\n'),
+                         'text/x-python')
+        self.assertEqual(sniff_text_mimetype(b'#!/bin/sh\necho\n'), 'text/x-shellscript')
+        self.assertEqual(sniff_text_mimetype(b'<!DOCTYPE html>\n<html></html>\n'), 'text/html')
+        self.assertEqual(sniff_text_mimetype(b'<?xml version="1.0"?>\n<svg/>\n'), 'image/svg+xml')
+        self.assertEqual(sniff_text_mimetype(b'Return-Path: <a@example.com>\n'), 'message/rfc822')
+
+    def test_falls_back_to_file_for_other_text(self):
+        for head in (
+            b'{"a": 1}\n',
+            b'<?php echo 1;\n',
+            b'import java.util.List;\npublic class A {}\n',
+            b'package main\n\nimport "fmt"\n\nfunc main() {}\n',
+            b'diff --git a/x b/x\n--- a/x\n+++ b/x\n',
+            b'#include <stdio.h>\nint main(void) { return 0; }\n',
+            b'#!/usr/bin/env unknown-interpreter\n',
+            b'Lorem ipsum dolor sit amet.\n',
+        ):
+            self.assertIsNone(sniff_text_mimetype(head), head)
+
+    def test_generic_text_mimetype_is_optional(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = pathlib.Path(dirpath) / 'notes'
+            filepath.write_bytes(b'Lorem ipsum dolor sit amet.\n')
+            self.assertIsNone(sniff_file_mimetype(filepath))
+            self.assertEqual(sniff_file_mimetype(filepath, text_mimetype='text/plain'),
+                             'text/plain')
+
+            filepath.write_bytes(b'\x89PNG\r\n\x1a\n' + bytes(64))
+            self.assertEqual(sniff_file_mimetype(filepath), 'image/png')
+
+    def test_sniffer_backend_labels_unrecognized_text(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = pathlib.Path(dirpath) / 'notes'
+            filepath.write_bytes(b'Lorem ipsum dolor sit amet.\n')
+            self.assertEqual(add_mime_file_extension.detect_mimetypes_with_sniffer([filepath]),
+                             ['text/plain'])
+
+
+class TestParseFileOutput(TestCase):
+    def test_names_with_any_characters(self):
+        filepaths = [b'plain', b'carriage\rreturn', b'new\nline', b'colon: space']
+        output = (b'plain\0text/plain\n'
+                  b'carriage\rreturn\0image/png\n'
+                  b'new\nline\0text/x-shellscript\n'
+                  b'colon: space\0: inode/x-empty\n')
+        self.assertEqual(parse_file_output(output, filepaths), {
+            b'plain': 'text/plain',
+            b'carriage\rreturn': 'image/png',
+            b'new\nline': 'text/x-shellscript',
+            b'colon: space': 'inode/x-empty',
+        })
+
+    def test_stops_at_unexpected_output(self):
+        self.assertEqual(parse_file_output(b'a\0text/plain\nx\0text/plain\n', [b'a', b'b']),
+                         {b'a': 'text/plain'})
+
+
+@skipIf(shutil.which('file') is None, 'requires the "file" command')
+class TestGetFileMimetypes(TestCase):
+    def test_single_batch_with_newlines_and_carriage_returns(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            contents = {
+                'carriage\rreturn': b'#!/bin/sh\necho\n',
+                'new\nline': b'#!/bin/sh\necho\n',
+                '-dash': b'',
+            }
+            filepaths = []
+            for basename, content in contents.items():
+                filepath = pathlib.Path(dirpath) / basename
+                filepath.write_bytes(content)
+                filepaths.append(filepath)
+
+            self.assertEqual(get_file_mimetypes(filepaths),
+                             ['text/x-shellscript', 'text/x-shellscript', 'inode/x-empty'])
+
+
+class TestRuleTrie(TestCase):
+    def _match_linearly(self, endings, basename):
+        # Like the old 'examine_*' handlers, checking every ending in turn.
+        matches = [ending for ending in endings if basename.endswith(ending)]
+        return max(matches, key=len) if matches else None
+
+    def test_matches_linear_search_of_rule_endings(self):
+        rng = random.Random(0)
+        endings_per_rule = [
+            rule['basename_endings'] for rule in MIMETYPE_RULES.values()
+            if isinstance(rule, dict) and rule.get('basename_endings')
+        ]
+        self.assertTrue(endings_per_rule)
+
+        for endings in endings_per_rule:
+            trie = compile_basename_endings(endings)
+            basenames = ['', 'README', 'notes.txt', '.bashrc']
+            for ending in endings:
+                basenames += [ending, 'x' + ending, ending + 'x', ending[1:],
+                              rng.choice(endings) + ending]
+            for basename in basenames:
+                self.assertEqual(match_basename_ending(trie, basename),
+                                 self._match_linearly(endings, basename), basename)
+
+    def test_longest_ending_wins(self):
+        trie = compile_basename_endings(['.gz', 'tar.gz', '.tar.gz'])
+        self.assertEqual(match_basename_ending(trie, 'foo.tar.gz'), '.tar.gz')
+        self.assertEqual(match_basename_ending(trie, 'footar.gz'), 'tar.gz')
+        self.assertEqual(match_basename_ending(trie, 'foo.gz'), '.gz')
+        self.assertIsNone(match_basename_ending(trie, 'foo.zip'))
+
+    def test_get_extension_matches_pathlib(self):
+        for basename in ('a.txt', '.bashrc', 'a.', 'a', 'a.tar.gz', '..', '.a.b'):
+            self.assertEqual(get_extension(basename),
+                             pathlib.PurePath(basename).suffix.lstrip('.'), basename)
+
+
+class TestRenameJournal(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = pathlib.Path(self._tempdir.name)
+        self.journal_path = self.dirpath / 'journal' / 'rename-journal.jsonl'
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _make_files(self, subdir, basenames):
+        dirpath = self.dirpath / subdir
+        dirpath.mkdir(exist_ok=True)
+        renames = []
+        for basename in basenames:
+            filepath = dirpath / basename
+            filepath.write_text(basename)
+            renames.append((str(filepath), str(filepath) + '.txt'))
+        return renames
+
+    def _read_records(self):
+        with open(self.journal_path, 'r', encoding='utf8') as filehandle:
+            return [json.loads(line) for line in filehandle]
+
+    def _write_records(self, records):
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path, 'w', encoding='utf8') as filehandle:
+            for record in records:
+                filehandle.write(json.dumps(record) + '\n')
+
+    def test_apply(self):
+        renames = self._make_files('a', ['x', 'y']) + self._make_files('b', ['z'])
+        journal = RenameJournal(self.journal_path, batch_size=100)
+        for source_path, destination_path in renames:
+            journal.add(source_path, destination_path)
+        journal.close()
+
+        self.assertEqual(journal.renamed_count, 3)
+        self.assertFalse(self.journal_path.exists())
+        for source_path, destination_path in renames:
+            self.assertFalse(os.path.lexists(source_path))
+            self.assertTrue(os.path.exists(destination_path))
+
+    def test_does_not_replace_existing_files(self):
+        renames = self._make_files('a', ['x', 'x.txt'])
+        journal = RenameJournal(self.journal_path, batch_size=100)
+        journal.add(*renames[0])
+        journal.close()
+
+        self.assertEqual(journal.renamed_count, 0)
+        self.assertEqual(pathlib.Path(renames[0][1]).read_text(), 'x.txt')
+
+    def test_pending_renames_are_bounded_across_directories(self):
+        renames = [self._make_files(str(index), ['x'])[0] for index in range(5)]
+        journal = RenameJournal(self.journal_path, batch_size=2)
+        for source_path, destination_path in renames:
+            journal.add(source_path, destination_path)
+        # Only one directory per rename, so no single directory ever
+        # reaches the batch size on its own.
+        self.assertEqual(journal.renamed_count, 4)
+        records = self._read_records()
+        self.assertEqual([record['op'] for record in records], ['begin', 'commit'] * 4)
+        journal.close()
+        self.assertEqual(journal.renamed_count, 5)
+
+    def test_resume_completes_uncommitted_batches(self):
+        committed = self._make_files('a', ['x'])
+        uncommitted = self._make_files('b', ['y', 'z'])
+        # Crashed after renaming the first file of the uncommitted batch.
+        os.rename(*uncommitted[0])
+        self._write_records([
+            {'op': 'begin', 'dirpath': str(self.dirpath / 'a'), 'renames': committed},
+            {'op': 'commit', 'dirpath': str(self.dirpath / 'a')},
+            {'op': 'begin', 'dirpath': str(self.dirpath / 'b'), 'renames': uncommitted},
+        ])
+
+        resume_journal(self.journal_path)
+
+        self.assertFalse(self.journal_path.exists())
+        # Committed batches are not performed again.
+        self.assertTrue(os.path.exists(committed[0][0]))
+        for source_path, destination_path in uncommitted:
+            self.assertFalse(os.path.lexists(source_path))
+            self.assertTrue(os.path.exists(destination_path))
+
+    def test_rollback_reverts_all_batches(self):
+        committed = self._make_files('a', ['x'])
+        uncommitted = self._make_files('b', ['y', 'z'])
+        os.rename(*committed[0])
+        os.rename(*uncommitted[0])
+        self._write_records([
+            {'op': 'begin', 'dirpath': str(self.dirpath / 'a'), 'renames': committed},
+            {'op': 'commit', 'dirpath': str(self.dirpath / 'a')},
+            {'op': 'begin', 'dirpath': str(self.dirpath / 'b'), 'renames': uncommitted},
+        ])
+        # A partially written last record is ignored.
+        with open(self.journal_path, 'a', encoding='utf8') as filehandle:
+            filehandle.write('{"op": "comm')
+
+        rollback_journal(self.journal_path)
+
+        self.assertFalse(self.journal_path.exists())
+        for source_path, destination_path in committed + uncommitted:
+            self.assertTrue(os.path.exists(source_path))
+            self.assertFalse(os.path.lexists(destination_path))
+
+
+class TestFindDuplicateFiles(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = pathlib.Path(self._tempdir.name)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _make_file(self, basename, content):
+        filepath = self.dirpath / basename
+        filepath.write_bytes(content)
+        return filepath
+
+    def _files(self, *filepaths):
+        return [(filepath, filepath.stat()) for filepath in filepaths]
+
+    def test_path_given_twice(self):
+        a = self._make_file('a', b'hello')
+        b = self._make_file('b', b'hello')
+        self._make_file('c', b'world')
+        self.assertEqual(find_duplicate_files(self._files(a, a, b)), {str(b): a})
+
+    def test_hardlinks(self):
+        a = self._make_file('a', b'hello')
+        b = self._make_file('b', b'hello')
+        link = self.dirpath / 'link'
+        os.link(str(a), str(link))
+        self.assertEqual(find_duplicate_files(self._files(a, link, a, b)),
+                         {str(link): a, str(b): a})
+
+    def test_same_file_through_different_paths(self):
+        a = self._make_file('a', b'hello')
+        b = self._make_file('b', b'hello')
+        paths = [str(a), str(self.dirpath / '.' / 'a'), str(b)]
+        duplicates = deduplicate_paths(paths, jobs=1)
+        self.assertEqual(duplicates, {str(b.resolve()): a.resolve()})
+        self.assertNotIn(str(a.resolve()), duplicates)
+
+    def test_large_files_differing_in_the_middle(self):
+        size = 3 * add_mime_file_extension.PARTIAL_HASH_BLOCK_SIZE
+        a = self._make_file('a', bytes(size))
+        b = self._make_file('b', bytes(size))
+        c = self._make_file('c', bytes(size // 2) + b'x' + bytes(size - size // 2 - 1))
+        self.assertEqual(find_duplicate_files(self._files(a, b, c)), {str(b): a})
+
+
+class TestMainExitCodes(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = pathlib.Path(self._tempdir.name)
+        self.filepath = self.dirpath / 'notes'
+        self.filepath.write_bytes(b'Lorem ipsum dolor sit amet.\n')
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _main(self, **options):
+        options.setdefault('filepaths', [str(self.filepath)])
+        options.setdefault('cache', False)
+        options.setdefault('detector', 'sniff')
+        options.setdefault('journal_path', self.dirpath / 'rename-journal.jsonl')
+        return main(dict(options, loglevel=logging.CRITICAL))
+
+    def test_success(self):
+        self.assertEqual(self._main(), 0)
+
+    def test_rollback_without_journal_fails(self):
+        self.assertEqual(self._main(rollback=True), 1)
+
+    def test_invalid_rules_fail(self):
+        rules_filepath = self.dirpath / 'rules.json'
+        rules_filepath.write_text('[]')
+        self.assertEqual(self._main(rules_filepaths=[str(rules_filepath)]), 1)
+
+
+class TestMimetypeCache(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = pathlib.Path(self._tempdir.name)
+        self.dbpath = self.dirpath / 'cache' / 'mimetypes.sqlite3'
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _make_file(self, basename, content=b'hello'):
+        filepath = self.dirpath / basename
+        filepath.write_bytes(content)
+        return filepath
+
+    def _cache(self, detector='file', max_entries=100, rebuild=False):
+        return MimetypeCache(self.dbpath, detector, max_entries, rebuild=rebuild)
+
+    def _store(self, entries, **kwargs):
+        cache = self._cache(**kwargs)
+        for filepath, mimetype in entries:
+            cache.put(filepath.stat(), mimetype)
+        cache.close()
+
+    def test_hit_and_miss(self):
+        a = self._make_file('a')
+        b = self._make_file('b')
+        self._store([(a, 'text/plain')])
+
+        cache = self._cache()
+        self.assertEqual(cache.get(a.stat()), 'text/plain')
+        self.assertIsNone(cache.get(b.stat()))
+        cache.close()
+
+    def test_invalidation(self):
+        a = self._make_file('a')
+        self._store([(a, 'text/plain')])
+
+        cache = self._cache(detector='sniff')
+        self.assertIsNone(cache.get(a.stat()))
+        cache.close()
+
+        a.write_bytes(b'hello, world')
+        cache = self._cache()
+        self.assertIsNone(cache.get(a.stat()))
+        cache.close()
+
+        a.write_bytes(b'hello')
+        self._store([(a, 'text/plain')])
+        cache = self._cache(rebuild=True)
+        self.assertIsNone(cache.get(a.stat()))
+        cache.close()
+
+    def test_errors_are_not_cached(self):
+        a = self._make_file('a')
+        b = self._make_file('b')
+        c = self._make_file('c')
+        self._store([(a, 'regular file, no read permission'), (b, ''), (c, None)])
+
+        cache = self._cache()
+        for filepath in (a, b, c):
+            self.assertIsNone(cache.get(filepath.stat()), filepath)
+        cache.close()
+
+    def test_evicts_least_recently_used_entries(self):
+        a = self._make_file('a')
+        b = self._make_file('b')
+        c = self._make_file('c')
+        self._store([(a, 'text/plain'), (b, 'text/plain')])
+
+        cache = self._cache(max_entries=2)
+        self.assertEqual(cache.get(a.stat()), 'text/plain')
+        cache.put(c.stat(), 'image/png')
+        cache.close()
+
+        cache = self._cache()
+        self.assertEqual(cache.get(a.stat()), 'text/plain')
+        self.assertIsNone(cache.get(b.stat()))
+        self.assertEqual(cache.get(c.stat()), 'image/png')
+        cache.close()
+
+
+class TestIterPaths(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = pathlib.Path(self._tempdir.name).resolve()
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _make_files(self, *relpaths):
+        for relpath in relpaths:
+            filepath = self.dirpath / relpath
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_bytes(b'')
+
+    def test_walks_sorted_and_prunes_git_directories(self):
+        self._make_files('b/d', 'b/c', 'a', '.git/config', 'sub/.git/HEAD', '.gitignore')
+        os.symlink('a', str(self.dirpath / 'link'))
+        os.symlink('b', str(self.dirpath / 'dirlink'))
+
+        entries = list(iter_paths([str(self.dirpath)], recursive=True))
+        self.assertEqual([entry.name for entry in entries],
+                         ['.gitignore', 'a', 'c', 'd', 'dirlink', 'link'])
+        self.assertEqual(
+            [resolve_directory_entry(entry)[2] for entry in entries],
+            ['Ignored filepath', None, None, None, 'Ignored symbolic link', 'Ignored symbolic link'],
+        )
+
+    def test_skips_unreadable_directories(self):
+        self._make_files('a/x', 'b/y', 'c/z')
+        unreadable_path = str(self.dirpath / 'b')
+        scandir = os.scandir
+
+        def _scandir(path):
+            if str(path) == unreadable_path:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        with mock.patch.object(add_mime_file_extension.os, 'scandir', _scandir):
+            entries = list(iter_paths([str(self.dirpath)], recursive=True))
+        self.assertEqual([entry.name for entry in entries], ['x', 'z'])
+
+    def test_files_and_non_recursive_paths_are_passed_through(self):
+        self._make_files('a/x')
+        paths = [str(self.dirpath / 'a'), str(self.dirpath / 'a' / 'x')]
+        self.assertEqual(list(iter_paths(paths)), paths)
+
+
+class TestIterOrderedResults(TestCase):
+    def test_results_are_in_chunk_order(self):
+        rng = random.Random(0)
+        delays = [rng.random() / 100 for _ in range(40)]
+
+        def _function(chunk):
+            time.sleep(delays[chunk])
+            return chunk * 2
+
+        for jobs in (1, 4):
+            self.assertEqual(list(iter_ordered_results(_function, iter(range(40)), jobs)),
+                             [chunk * 2 for chunk in range(40)], jobs)
+
+    def test_bounds_chunks_in_flight(self):
+        jobs = 3
+        submitted = []
+        lock = threading.Lock()
+
+        def _chunks():
+            for chunk in range(50):
+                with lock:
+                    submitted.append(chunk)
+                yield chunk
+
+        for index, result in enumerate(iter_ordered_results(lambda chunk: chunk, _chunks(), jobs)):
+            self.assertEqual(result, index)
+            self.assertLessEqual(len(submitted) - index, jobs * 2)
+
+
+class TestJsonLinesWriter(TestCase):
+    def test_writes_in_blocks(self):
+        stream = io.StringIO()
+        writer = JsonLinesWriter(stream, block_size=2)
+        writer.write({'path': 'a'})
+        self.assertEqual(stream.getvalue(), '')
+        writer.write({'path': 'b'})
+        self.assertEqual(stream.getvalue(), '{"path": "a"}\n{"path": "b"}\n')
+        writer.write({'path': 'c'})
+        self.assertEqual(stream.getvalue().count('\n'), 2)
+        writer.flush()
+        writer.flush()
+        self.assertEqual([json.loads(line) for line in stream.getvalue().splitlines()],
+                         [{'path': 'a'}, {'path': 'b'}, {'path': 'c'}])
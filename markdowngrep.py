@@ -18,17 +18,79 @@
 
 
 import argparse
+import array
+import bisect
+import codecs
+import collections.abc
+import fnmatch
+import functools
+import heapq
+import itertools
+import io
+import json
+import locale
 import logging
+import mmap
+import multiprocessing
+import os
 import time
 import sys
 import re
 import pprint
 import fileinput
+import sqlite3
 
 from colorama import Fore
 
 log = logging.getLogger()
 
+# https://github.com/lepture/mistune/blob/master/mistune.py
+# Indented by four or more spaces, it is code or part of a paragraph.
+RE_HEADING = re.compile(r'^ {0,3}(#{1,6}) *([^\n]+?) *#* *(?:\n+|$)')
+
+# Underline of a Setext-style header, which makes the preceding line the
+# heading text.
+# https://github.com/waylan/Python-Markdown/blob/master/markdown
+# /blockprocessors.py
+RE_SETEXT_UNDERLINE = re.compile(r'[=-]+[ ]*$')
+
+# Opening or closing line of a fenced code block.
+RE_CODE_FENCE = re.compile(r' {0,3}(`{3,}|~{3,})(.*)$')
+
+# YAML front matter starts with this as the first line.
+FRONT_MATTER_START = '---'
+FRONT_MATTER_ENDS = frozenset(['---', '...'])
+
+# Only lines starting with any of these can be headings, underlines, code
+# fences or the end of front matter, so all other lines skip the regular
+# expressions entirely.
+BLOCK_FIRST_CHARACTERS = frozenset('# =-`~.')
+
+# Only lines starting with any of these can close a fenced code block.
+CODE_FENCE_FIRST_CHARACTERS = frozenset(' `~')
+
+# Lines starting like any of the above, for finding them in undecoded file
+# contents.  Searched for separately from the PATTERN, since the regular
+# expression engine only skips ahead quickly for expressions with a
+# literal prefix.
+RE_CANDIDATE_FIRST_BLOCK = re.compile(rb' *#|[=-]| {0,3}(?:```|~~~)|\.\.\.')
+RE_CANDIDATE_BLOCK = re.compile(rb'\n(?: *#|[=-]| {0,3}(?:```|~~~)|\.\.\.)')
+
+# Syntax that can match differently in bytes and in decoded text.  Classes
+# like '\w' and '.' match single bytes rather than characters, and '$' does
+# not skip the trailing whitespace stripped from decoded lines.
+RE_UNSAFE_CANDIDATE_SYNTAX = re.compile(r'[\\.$]|\[\^|\(\?(?!:)')
+
+# With re.IGNORECASE, these also match some non-ASCII characters in text,
+# like 'K' matches the Kelvin sign, but only themselves in bytes.
+RE_UNSAFE_IGNORECASE_CANDIDATE_SYNTAX = re.compile(r'[iksIKS\[]')
+
+# Text mode reads a carriage return not followed by a newline as a line
+# break, which the byte level search does not.
+RE_LONE_CARRIAGE_RETURN = re.compile(rb'\r(?!\n)')
+
+RE_NEWLINE = re.compile(rb'\n')
+
 
 def parse_commandline():
     parser = argparse.ArgumentParser(prog='markdowngrep',
@@ -49,7 +111,7 @@ def parse_commandline():
                              'additional output.')
 
     parser.add_argument(dest='pattern',
-                        nargs=1,
+                        nargs='?',
                         metavar='PATTERN',
                         help='Regular expression to match.')
 
@@ -59,12 +121,33 @@ def parse_commandline():
                         help='Files to search.')
 
     arg_group_match = parser.add_argument_group('matching control')
+    arg_group_match.add_argument('-e', '--regexp',
+                                 dest='patterns',
+                                 action='append',
+                                 default=[],
+                                 metavar='PATTERN',
+                                 help='Regular expression to match. Repeat '
+                                      'to match lines matching any of the '
+                                      'patterns. If given, the first '
+                                      'positional argument is a FILE.')
     arg_group_match.add_argument('-i', '--ignore-case',
                                  dest='ignore_case',
                                  action='store_true',
                                  help='Ignore case distinctions in the '
                                       'PATTERN.')
 
+    arg_group_input = parser.add_argument_group('file selection')
+    arg_group_input.add_argument('-r', '--recursive',
+                                 dest='recursive',
+                                 action='store_true',
+                                 default=False,
+                                 help='Search markdown files in directories '
+                                      'recursively, skipping ".git", '
+                                      '"node_modules" and paths ignored by '
+                                      '".gitignore" files. Searches the '
+                                      'current directory if no FILE is '
+                                      'given.')
+
     arg_group_output = parser.add_argument_group('output options')
     arg_group_output.add_argument('-t', '--top-level',
                                   dest='top_level',
@@ -93,7 +176,77 @@ def parse_commandline():
                                        'I.E. Traverse all parents, all the '
                                        'way up to the tree root.')
 
+    arg_group_output.add_argument('--format',
+                                  dest='output_format',
+                                  choices=('text', 'jsonl'),
+                                  default='text',
+                                  help='Print aligned columns of text '
+                                       '(default) or one JSON object per '
+                                       'match as soon as it is found, with '
+                                       'the file, line number, text and '
+                                       'parent headings. Line numbers are '
+                                       'counted from 1 and per file.')
+
+    arg_group_output.add_argument('-s', '--stream',
+                                  dest='stream',
+                                  action='store_true',
+                                  default=False,
+                                  help='Search one file at a time and print '
+                                       'matches as they are found, with '
+                                       'line numbers counted per file. '
+                                       'Columns are not aligned to the '
+                                       'widest entry.')
+
+    arg_group_perf = parser.add_argument_group('performance options')
+    arg_group_perf.add_argument('-j', '--jobs',
+                                dest='jobs',
+                                type=int,
+                                default=1,
+                                metavar='N',
+                                help='Search files in N worker processes. '
+                                     'Results are printed in the order the '
+                                     'files were given, with line numbers '
+                                     'counted per file. Default: %(default)s')
+
+    arg_group_perf.add_argument('--cache',
+                                dest='cache',
+                                action='store_true',
+                                default=False,
+                                help='Store the heading outline of searched '
+                                     'files on disk and reuse it for files '
+                                     'with unchanged size and modification '
+                                     'time. Searches one file at a time, '
+                                     'with line numbers counted per file.')
+    arg_group_perf.add_argument('--cache-path',
+                                dest='cache_path',
+                                default=None,
+                                metavar='PATH',
+                                help='Outline cache database used by '
+                                     '"--cache". Default: '
+                                     '$XDG_CACHE_HOME/markdowngrep/'
+                                     'outlines.sqlite3')
+    arg_group_perf.add_argument('--cache-max-entries',
+                                dest='cache_max_entries',
+                                type=int,
+                                default=DEFAULT_CACHE_MAX_ENTRIES,
+                                metavar='N',
+                                help='Evict the least recently used outlines '
+                                     'beyond N files. Default: %(default)s')
+
     args = parser.parse_args()
+    if args.patterns:
+        if args.pattern is not None:
+            args.file.insert(0, args.pattern)
+    elif args.pattern is None:
+        parser.error('the following arguments are required: PATTERN')
+    else:
+        args.patterns = [args.pattern]
+
+    if args.jobs < 1:
+        parser.error('argument -j/--jobs: must be a positive integer')
+    if args.cache_max_entries < 1:
+        parser.error('argument --cache-max-entries: must be a positive '
+                     'integer')
     return args
 
 
@@ -104,106 +257,854 @@ def process_input(input, pattern):
     input_data = [line.rstrip() for line in input]
     # input_data = input
 
-    matches = []
-    for num, line in enumerate(input_data):
-        if line.strip():
+    matches = find_matches(input_data, pattern)
+    # Formatting every parent of every match is slow, so only do it when
+    # it is logged.  Any '--level' is applied when displaying matches.
+    if log.isEnabledFor(logging.DEBUG):
+        for match in matches:
+            log.debug('Found match:')
+            for line in pprint.pformat(match).split('\n'):
+                log.debug(line)
+
+    return matches
+
+
+def iter_input_matches(filepaths, pattern, cache=None):
+    """
+    Searches one file at a time and yields matches as they are found, with
+    line numbers counted per file and the file name added to each match.
+    Reads standard input if no files are given, like 'fileinput'.
+    """
+    candidate_pattern = compile_candidate_pattern(pattern)
+    for filepath in filepaths or ['-']:
+        for match in iter_file_matches(filepath, pattern, candidate_pattern,
+                                       cache):
+            match['file'] = filepath
+            yield match
+
+
+def iter_file_matches(filepath, pattern, candidate_pattern=None, cache=None):
+    """
+    Searches a single file, or standard input if 'filepath' is '-'.
+
+    Given a 'candidate_pattern' from 'compile_candidate_pattern()', the file
+    is memory-mapped and only the lines it finds are decoded and searched.
+    Given an 'OutlineCache', the headings and line offsets of the file are
+    taken from the cache instead of being parsed, if the file is unchanged.
+    Otherwise, or if the file can not be mapped, every line is decoded.
+    """
+    if filepath == '-':
+        yield from iter_matches((line.rstrip() for line in sys.stdin),
+                                pattern)
+        return
+
+    try:
+        input_file = open(filepath, 'rb')
+    except OSError as e:
+        log.error('Unable to read "{}": {}'.format(filepath, e))
+        return
+
+    with input_file:
+        buf = None
+        if candidate_pattern is not None or (cache is not None
+                                             and is_utf8_locale()):
+            try:
+                buf = mmap.mmap(input_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # Empty files and some special files can not be mapped.
+                pass
+
+        if buf is not None and RE_LONE_CARRIAGE_RETURN.search(buf):
+            buf.close()
+            buf = None
+
+        if buf is None:
+            text_file = io.TextIOWrapper(input_file)
+            yield from iter_matches((line.rstrip() for line in text_file),
+                                    pattern)
+            return
+
+        with buf:
+            if cache is None:
+                yield from iter_numbered_line_matches(
+                    iter_candidate_lines(buf, candidate_pattern), pattern)
+                return
+
+            cache_key = os.path.realpath(filepath)
+            file_stat = os.fstat(input_file.fileno())
+            outline_index = cache.get(cache_key, file_stat)
+            if outline_index is None:
+                outline_index = build_outline_index(buf)
+                cache.put(cache_key, file_stat, *outline_index)
+
+            yield from iter_outline_index_matches(buf, outline_index, pattern,
+                                                  candidate_pattern)
+
+
+def build_outline_index(buf):
+    """
+    Returns the outline of the UTF-8 encoded 'buf' and the offsets of the
+    start of each line.
+
+    The outline is a list of (line number found at, heading line number,
+    level, text) in the order that the headings are found when searching.
+    """
+    size = len(buf)
+    line_starts = array.array('Q', [0])
+    line_starts.extend(m.end() for m in RE_NEWLINE.finditer(buf)
+                       if m.end() < size)
+
+    outline = []
+    for num, _, headings in iter_tokenized_lines(iter_candidate_lines(buf)):
+        for heading in reversed(headings):
+            outline += [(num, heading['line'], heading['level'],
+                         heading['text'])]
+
+    return outline, line_starts
+
+
+def line_end(buf, line_starts, num):
+    if num + 1 < len(line_starts):
+        return line_starts[num + 1]
+    return len(buf)
+
+
+def iter_outline_index_matches(buf, outline_index, pattern,
+                               candidate_pattern=None):
+    """
+    Searches the UTF-8 encoded 'buf' using an outline and line offsets from
+    'build_outline_index()', without parsing any headings.  Only lines found
+    by any 'candidate_pattern' are decoded.
+    """
+    outline, line_starts = outline_index
+    found_at = [entry[0] for entry in outline]
+    headings = [{'line': line, 'level': level, 'text': text}
+                for _, line, level, text in outline]
+
+    if candidate_pattern is None:
+        nums = range(len(line_starts))
+    else:
+        nums = (bisect.bisect_right(line_starts, start) - 1
+                for start in iter_candidate_match_starts(buf,
+                                                         candidate_pattern))
+
+    for num in nums:
+        line = buf[line_starts[num]:line_end(buf, line_starts, num)]
+        line = line.decode('utf-8').rstrip()
+        if line and not line.isspace():
             if has_match(line, pattern):
-                matches += [{'line': num,
-                             'text': line.strip()}]
+                count = bisect.bisect_right(found_at, num)
+                yield {'line': num,
+                       'text': line.strip(),
+                       'parents': ParentHeadings(headings, count)}
 
-    for match in matches:
-        match['parents'] = find_line_parent_headings(input_data, match['line'])
 
-        if not log.debug:
+# Bumped whenever the stored outlines would differ for the same file.
+OUTLINE_CACHE_VERSION = 2
+
+DEFAULT_CACHE_MAX_ENTRIES = 10000
+
+
+def get_default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'markdowngrep', 'outlines.sqlite3')
+
+
+class OutlineCache(object):
+    """
+    SQLite database of file outlines and line offsets, keyed by path and
+    checked against the file size and modification time.  Used from one
+    process per database connection; worker processes open their own.
+    """
+    def __init__(self, path, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+        dirpath = os.path.dirname(path)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30)
+        # Write-ahead logging lets worker processes read while another one
+        # writes, and makes commits cheap enough to do once per file.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS outlines ('
+            ' path TEXT PRIMARY KEY,'
+            ' version INTEGER NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' outline TEXT NOT NULL,'
+            ' line_starts BLOB NOT NULL,'
+            ' last_used REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def get(self, path, file_stat):
+        row = self.connection.execute(
+            'SELECT outline, line_starts FROM outlines'
+            ' WHERE path = ? AND version = ? AND size = ? AND mtime_ns = ?',
+            (path, OUTLINE_CACHE_VERSION, file_stat.st_size,
+             file_stat.st_mtime_ns)
+        ).fetchone()
+        if row is None:
+            log.debug('Outline cache miss: {}'.format(path))
+            return None
+
+        self.connection.execute(
+            'UPDATE outlines SET last_used = ? WHERE path = ?',
+            (time.time(), path)
+        )
+        self.connection.commit()
+
+        outline = [tuple(entry) for entry in json.loads(row[0])]
+        line_starts = array.array('Q')
+        line_starts.frombytes(row[1])
+        return outline, line_starts
+
+    def put(self, path, file_stat, outline, line_starts):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO outlines VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, OUTLINE_CACHE_VERSION, file_stat.st_size,
+             file_stat.st_mtime_ns, json.dumps(outline),
+             line_starts.tobytes(), time.time())
+        )
+        self.connection.commit()
+
+    def close(self):
+        # Evict the least recently used outlines beyond the maximum size.
+        self.connection.execute(
+            'DELETE FROM outlines WHERE path NOT IN ('
+            ' SELECT path FROM outlines ORDER BY last_used DESC LIMIT ?)',
+            (self.max_entries,)
+        )
+        self.connection.commit()
+        self.connection.close()
+
+
+# Outline caches opened by worker processes, by database path.
+_worker_caches = {}
+
+
+def get_worker_cache(cache_path):
+    if cache_path not in _worker_caches:
+        _worker_caches[cache_path] = OutlineCache(cache_path)
+    return _worker_caches[cache_path]
+
+
+def is_utf8_locale():
+    # Files are opened in text mode with the locale encoding.
+    return codecs.lookup(locale.getpreferredencoding(False)).name == 'utf-8'
+
+
+# Characters with a special meaning in regular expressions.
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+# Quantifiers that make the preceding character optional.
+REGEX_OPTIONAL_QUANTIFIERS = frozenset('*?{')
+
+
+def find_literal_prefix(source):
+    """
+    Returns the literal text that every match of the regular expression
+    'source' starts with, which is all of 'source' if it has no special
+    characters, or an empty string if not known.
+    """
+    if '|' in source:
+        return ''
+
+    prefix = []
+    for character in source:
+        if character in REGEX_METACHARACTERS:
+            if character in REGEX_OPTIONAL_QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix += [character]
+    return ''.join(prefix)
+
+
+class PatternMatcher(object):
+    """
+    Searches lines for any of one or more compiled regular expressions.
+
+    Patterns without special characters are searched for as substrings.
+    Other patterns are only run on lines containing their literal prefix,
+    if they have one.  With re.IGNORECASE, prefixes are compared in lower
+    case, and only if they are ASCII without 'i', 'k' or 's', which also
+    match non-ASCII characters like the Kelvin sign.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+        # Substrings to search for, if all patterns are literal text.
+        self.literals = None
+        if all(not p.flags & re.IGNORECASE
+               and find_literal_prefix(p.pattern) == p.pattern
+               for p in patterns):
+            self.literals = [p.pattern for p in patterns]
+
+        self.prefilters = []
+        for pattern in patterns:
+            prefix = find_literal_prefix(pattern.pattern)
+            ignore_case = bool(pattern.flags & re.IGNORECASE)
+            if ignore_case:
+                if (RE_UNSAFE_IGNORECASE_CANDIDATE_SYNTAX.search(prefix)
+                        or not prefix.isascii()):
+                    prefix = ''
+                prefix = prefix.lower()
+            self.prefilters += [(pattern, prefix, ignore_case)]
+
+    def search(self, line):
+        if self.literals is not None:
+            for literal in self.literals:
+                if literal in line:
+                    return True
+            return False
+
+        lowered_line = None
+        for pattern, prefix, ignore_case in self.prefilters:
+            if prefix:
+                if ignore_case:
+                    if lowered_line is None:
+                        lowered_line = line.lower()
+                    if prefix not in lowered_line:
+                        continue
+                elif prefix not in line:
+                    continue
+            if pattern.search(line):
+                return True
+        return False
+
+
+def compile_candidate_pattern(matcher):
+    """
+    Returns what finds every line that could contain a match of the
+    'PatternMatcher', for searching files without decoding them.  This is
+    a tuple of UTF-8 encoded substrings if all patterns are literal text,
+    otherwise a bytes regular expression.
+
+    Returns None if any pattern could match some text that the bytes
+    expression would miss, in which case every line has to be decoded.
+    """
+    if not is_utf8_locale():
+        return None
+
+    if matcher.literals is not None:
+        return tuple(literal.encode('utf-8') for literal in matcher.literals)
+
+    sources = []
+    flags = re.MULTILINE
+    for pattern in matcher.patterns:
+        if pattern.flags & ~(re.IGNORECASE | re.UNICODE):
+            return None
+
+        try:
+            source = pattern.pattern.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+
+        if any(c < 0x20 or c == 0x7f for c in source):
+            return None
+        if RE_UNSAFE_CANDIDATE_SYNTAX.search(pattern.pattern):
+            return None
+        if pattern.flags & re.IGNORECASE:
+            if RE_UNSAFE_IGNORECASE_CANDIDATE_SYNTAX.search(pattern.pattern):
+                return None
+            # Finding more candidates than needed is fine.
+            flags |= re.IGNORECASE
+
+        sources += [source]
+
+    if len(sources) == 1:
+        return re.compile(sources[0], flags)
+    return re.compile(b'|'.join(b'(?:' + source + b')' for source in sources),
+                      flags)
+
+
+def iter_candidate_lines(buf, candidate_pattern=None):
+    """
+    Yields tuples of line number, line and previous line for the lines of
+    the UTF-8 encoded 'buf' that could be headings or open or close a block
+    in 'iter_tokenized_lines()', or that any 'candidate_pattern' finds.
+    The previous line is only decoded if the line could be a Setext-style
+    underline.
+
+    Line numbers are counted incrementally between the candidate lines, so
+    lines without candidates are never decoded or split.
+    """
+    size = len(buf)
+    line_starts = iter_candidate_block_starts(buf)
+    if candidate_pattern is not None:
+        line_starts = heapq.merge(line_starts,
+                                  iter_candidate_match_starts(
+                                      buf, candidate_pattern))
+    num = 0
+    counted_to = 0
+    previous_num = -1
+    previous_line = None
+    for start in line_starts:
+        # Lines with both a block and a match candidate come up twice.
+        if start == counted_to and previous_num == num:
             continue
-        log.debug('Found match:')
-        for line in pprint.pformat(match).split('\n'):
-            log.debug(line)
+        end = buf.find(b'\n', start)
+        if end == -1:
+            end = size
 
-    if args.level:
-        log.debug('Level filter ENABLED')
+        # 'mmap' has no 'count()', and copying the skipped bytes to count
+        # them is no slower than counting in place with 'RE_NEWLINE'.
+        num += buf[counted_to:start].count(b'\n')
+        counted_to = start
 
-        for match in matches:
-            parents = match['parents']
-            parents[:] = [p for p in parents if p['level'] <= args.level]
+        line = buf[start:end].decode('utf-8').rstrip()
+        if num == previous_num + 1:
+            previous = previous_line
+        elif num > 0 and line[:1] in ('=', '-'):
+            previous_start = buf.rfind(b'\n', 0, start - 1) + 1
+            previous = buf[previous_start:start - 1].decode('utf-8').rstrip()
+        else:
+            previous = None
 
-    for match in matches:
-        log.debug('Filtered results:')
-        for line in pprint.pformat(match).split('\n'):
-            log.debug(line)
+        yield num, line, previous
 
-    return matches
+        previous_num = num
+        previous_line = line
+
+
+def iter_candidate_block_starts(buf):
+    if RE_CANDIDATE_FIRST_BLOCK.match(buf):
+        yield 0
+    for m in RE_CANDIDATE_BLOCK.finditer(buf):
+        yield m.start() + 1
+
+
+def iter_candidate_match_starts(buf, candidate_pattern):
+    # Yields the start of every line with a match, once per line.
+    if isinstance(candidate_pattern, tuple):
+        line_starts = heapq.merge(*[iter_literal_line_starts(buf, literal)
+                                    for literal in candidate_pattern])
+    else:
+        line_starts = iter_pattern_line_starts(buf, candidate_pattern)
+
+    previous_start = -1
+    for start in line_starts:
+        if start != previous_start:
+            yield start
+            previous_start = start
+
+
+def iter_literal_line_starts(buf, literal):
+    # Uses 'find', which is a lot faster than even a literal regex search.
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        index = buf.find(literal, pos)
+        if index == -1:
+            break
+
+        yield buf.rfind(b'\n', 0, index) + 1
+
+        end = buf.find(b'\n', index)
+        if end == -1:
+            break
+        pos = end + 1
+
+
+def iter_pattern_line_starts(buf, candidate_pattern):
+    search = candidate_pattern.search
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        m = search(buf, pos)
+        if not m:
+            break
+
+        start = buf.rfind(b'\n', 0, m.start()) + 1
+        yield start
+
+        end = buf.find(b'\n', m.start())
+        if end == -1:
+            break
+        pos = end + 1
+
+
+# Files with any of these extensions are searched by '--recursive'.
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+
+# Directories never descended into by '--recursive'.
+PRUNED_DIRNAMES = frozenset(['.git', 'node_modules'])
+
+
+def iter_input_filepaths(paths):
+    """
+    Yields 'paths' with any directories replaced by the markdown files they
+    contain, in sorted order.  Directories are walked lazily, so searching
+    can start before the whole tree has been listed.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk_markdown_files(path, [])
+        else:
+            yield path
+
+
+def walk_markdown_files(dirpath, gitignores):
+    gitignore = read_gitignore(dirpath)
+    if gitignore:
+        gitignores = gitignores + [(dirpath, gitignore)]
+
+    try:
+        entries = sorted(os.scandir(dirpath), key=lambda e: e.name)
+    except OSError as e:
+        log.error('Unable to list "{}": {}'.format(dirpath, e))
+        return
+
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if is_dir and entry.name in PRUNED_DIRNAMES:
+            continue
+        if gitignores and is_gitignored(entry.path, entry.name, is_dir,
+                                        gitignores):
+            continue
+
+        if is_dir:
+            yield from walk_markdown_files(entry.path, gitignores)
+        elif entry.name.lower().endswith(MARKDOWN_EXTENSIONS):
+            yield entry.path
+
+
+def read_gitignore(dirpath):
+    """
+    Returns the patterns of any '.gitignore' file in 'dirpath' as a list of
+    (compiled pattern, negated, directories only, match the relative path)
+    tuples.  Covers the common subset of the gitignore syntax; character
+    classes and '**' are handled by 'fnmatch', where '*' also matches '/'.
+    """
+    try:
+        with open(os.path.join(dirpath, '.gitignore')) as gitignore_file:
+            lines = gitignore_file.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return []
+
+    patterns = []
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line.startswith('**/'):
+            line = line[3:]
+        anchored = '/' in line
+        line = line.lstrip('/')
+        if not line:
+            continue
+
+        regex = re.compile(fnmatch.translate(line))
+        patterns += [(regex, negated, dir_only, anchored)]
+
+    return patterns
+
+
+def is_gitignored(path, name, is_dir, gitignores):
+    # Later patterns and deeper '.gitignore' files take precedence.
+    ignored = False
+    for dirpath, patterns in gitignores:
+        relpath = path[len(dirpath):].lstrip(os.sep)
+        for regex, negated, dir_only, anchored in patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath if anchored else name):
+                ignored = not negated
+    return ignored
+
+
+# Number of files sent to a worker process at a time by '--jobs'.
+JOBS_CHUNKSIZE = 16
+
+
+def iter_parallel_input_matches(filepaths, pattern, jobs, cache_path=None):
+    """
+    Searches files in a pool of 'jobs' worker processes and yields their
+    matches in the order of 'filepaths'.
+    """
+    search = functools.partial(search_file, pattern=pattern,
+                               cache_path=cache_path)
+    with multiprocessing.Pool(jobs) as pool:
+        for file_matches in pool.imap(search, filepaths, JOBS_CHUNKSIZE):
+            yield from file_matches
+
+
+def search_file(filepath, pattern, cache_path=None):
+    cache = None
+    if cache_path is not None:
+        cache = get_worker_cache(cache_path)
+    return list(iter_input_matches([filepath], pattern, cache))
+
+
+def find_matches(text_lines, pattern):
+    return list(iter_matches(text_lines, pattern))
+
+
+def iter_matches(lines, pattern):
+    """
+    Searches 'lines' for 'pattern' and the headings preceding each match,
+    in a single forward pass over any iterable of lines.
+
+    Headings are collected as they are passed, so the parents of a match are
+    the headings seen so far, closest first, instead of the result of
+    scanning backwards from every match to the first line.  Only the
+    headings and the previous line are kept, not the lines themselves.
+    """
+    return iter_numbered_line_matches(iter_numbered_lines(lines), pattern)
+
+
+def iter_numbered_lines(lines):
+    previous_line = None
+    for num, line in enumerate(lines):
+        yield num, line, previous_line
+        previous_line = line
+
+
+def iter_numbered_line_matches(numbered_lines, pattern):
+    """
+    Searches tuples of line number, line and previous line, which may skip
+    lines that are neither headings nor matches.
+    """
+    headings = []
+    for num, line, line_headings in iter_tokenized_lines(numbered_lines):
+        if line_headings:
+            # Keep the headings found on this line in the order the backward
+            # scan in 'find_line_parent_headings()' used to return them.
+            headings.extend(reversed(line_headings))
+
+        if line and not line.isspace():
+            if has_match(line, pattern):
+                yield {'line': num,
+                       'text': line.strip(),
+                       'parents': ParentHeadings(headings, len(headings))}
+
+
+class ParentHeadings(collections.abc.Sequence):
+    """
+    The headings preceding a match, closest first, as a view of the first
+    'count' headings of a list that is only ever appended to.
+
+    Every match shares the same list, so a match costs the same no matter
+    how many headings precede it.  Only the parents that are displayed are
+    ever looked at, which is usually just the closest one.
+    """
+    __slots__ = ('_headings', '_count')
+
+    def __init__(self, headings, count):
+        self._headings = headings
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('parent heading index out of range')
+        return self._headings[self._count - 1 - index]
+
+    def __iter__(self):
+        for index in range(self._count - 1, -1, -1):
+            yield self._headings[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def iter_displayed_parents(match):
+    """
+    Yields the parents of a match that are displayed, which are those at
+    or above any '--level', and only the closest one unless '--all-parents'
+    is given.
+    """
+    parents = iter(match['parents'])
+    if args.level:
+        parents = (p for p in parents if p['level'] <= args.level)
+    if not args.all_parents:
+        parents = itertools.islice(parents, 1)
+    return parents
 
 
 def has_match(line, regexp):
     return line if regexp.search(line) else False
 
 
-def display_results(matches):
+# Minimum field widths used when printing results.
+DEFAULT_TEXTWIDTHS = (4, 7, 16)
+
+
+def display_results(matches, show_filename=False):
     # Figure out field widths required to fit largest entries.
-    textwidth_lineno = 4
-    textwidth_parent = 7
-    textwidth_match = 16
+    textwidth_lineno, textwidth_parent, textwidth_match = DEFAULT_TEXTWIDTHS
     for match in matches:
         textwidth_match = max(textwidth_match, len(match['text']))
-        for parent in match['parents']:
+        for parent in iter_displayed_parents(match):
             textwidth_parent = max(textwidth_parent, len(parent['text']))
             textwidth_lineno = max(textwidth_lineno, len(str(parent['line'])))
-
-    # Local function for printing a columnated line.
-    def print_line(line_num, level, text_parent, text_match):
-        if type(level) == int:
-            lvl = '#' * level
-        else:
-            lvl = 'Level'
-        print('{n:{twn}} {l:6} {tp:{twp}}   {tm:{twm}}'.format(n=line_num,
-                                                          twn=textwidth_lineno,
-                                                          l=lvl,
-                                                          tp=text_parent,
-                                                          twp=textwidth_parent,
-                                                          tm=text_match,
-                                                          twm=textwidth_match))
+    textwidths = (textwidth_lineno, textwidth_parent, textwidth_match)
 
     # Print header.
     if args.verbose > 0:
-        print_line('Line', 'Level', 'Heading', 'Matching pattern')
+        print_line('Line', 'Level', 'Heading', 'Matching pattern', textwidths)
 
     for match in matches:
-        for parent in match['parents']:
-            print_line(parent['line'] + 1, parent['level'], parent['text'],
-                       match['text'])
-            if not args.all_parents:
-                break
+        display_match(match, textwidths, show_filename)
 
 
-def find_line_parent_headings(text_lines, start_line):
-    # https://github.com/lepture/mistune/blob/master/mistune.py
-    heading = re.compile(r'^ *(#{1,6}) *([^\n]+?) *#* *(?:\n+|$)')
+def display_match_json(match):
+    parents = iter_displayed_parents(match)
 
-    # Detect Setext-style header. Must be first 2 lines of block.
-    # https://github.com/waylan/Python-Markdown/blob/master/markdown
-    # /blockprocessors.py
-    lheading = re.compile(r'^.*?\n[=-]+[ ]*(\n|$)', re.MULTILINE)
+    print(json.dumps({
+        'file': match.get('file'),
+        'line': match['line'] + 1,
+        'text': match['text'],
+        'parents': [{'line': parent['line'] + 1,
+                     'level': parent['level'],
+                     'text': parent['text']} for parent in parents],
+    }, ensure_ascii=False))
 
-    parents = []
-    i = start_line
-    while i >= 0:
-        sr_h = re.match(heading, text_lines[i])
-        if sr_h:
-            parents += [{'line': i,
-                         'level': len(sr_h.group(1)),
-                         'text': sr_h.group(2)}]
-
-        sr_lh = re.match(lheading, text_lines[i - 1] + '\n' + text_lines[i])
-        if sr_lh:
-            if text_lines[i].startswith('='):
-                level = 1
+
+def display_match(match, textwidths, show_filename=False):
+    filename = match['file'] if show_filename else None
+    for parent in iter_displayed_parents(match):
+        print_line(parent['line'] + 1, parent['level'], parent['text'],
+                   match['text'], textwidths, filename)
+
+
+def print_line(line_num, level, text_parent, text_match, textwidths,
+               filename=None):
+    # Prints a columnated line.
+    textwidth_lineno, textwidth_parent, textwidth_match = textwidths
+    if type(level) == int:
+        lvl = '#' * level
+    else:
+        lvl = 'Level'
+    line = '{n:{twn}} {l:6} {tp:{twp}}   {tm:{twm}}'.format(n=line_num,
+                                                         twn=textwidth_lineno,
+                                                         l=lvl,
+                                                         tp=text_parent,
+                                                         twp=textwidth_parent,
+                                                         tm=text_match,
+                                                         twm=textwidth_match)
+    if filename is not None:
+        line = '{}:{}'.format(filename, line)
+    print(line)
+
+
+def iter_tokenized_lines(numbered_lines):
+    """
+    Yields tuples of line number, line and the headings found at the line,
+    from tuples of line number, line and previous line.
+
+    Keeps track of fenced code blocks and YAML front matter as it goes, so
+    that lines in them are never taken for headings, without looking back
+    or ahead.  Lines may be left out if they do not start with any of
+    'BLOCK_FIRST_CHARACTERS', as long as the previous line of any possible
+    Setext-style underline is given.
+    """
+    fence = None
+    in_front_matter = False
+
+    # Last line known not to be paragraph text, which a Setext-style
+    # underline would turn into a heading.  Lines left out are judged by
+    # 'is_paragraph_text()' alone.
+    not_text_num = -1
+
+    for num, line, previous_line in numbered_lines:
+        headings = ()
+        first_character = line[:1]
+        if fence is not None:
+            if first_character in CODE_FENCE_FIRST_CHARACTERS:
+                m = RE_CODE_FENCE.match(line)
+                if (m and m.group(1)[0] == fence[0]
+                        and len(m.group(1)) >= len(fence)
+                        and not m.group(2).strip()):
+                    fence = None
+            not_text_num = num
+        elif in_front_matter:
+            if line in FRONT_MATTER_ENDS:
+                in_front_matter = False
+            not_text_num = num
+        elif num == 0 and line == FRONT_MATTER_START:
+            in_front_matter = True
+            not_text_num = num
+        elif first_character in BLOCK_FIRST_CHARACTERS:
+            m = RE_CODE_FENCE.match(line)
+            # Info strings of backtick fences can not contain backticks.
+            if m and not (m.group(1)[0] == '`' and '`' in m.group(2)):
+                fence = m.group(1)
+                not_text_num = num
             else:
-                level = 2
-            parents += [{'line': i - 1,
-                         'level': level,
-                         'text': text_lines[i - 1]}]
-        i -= 1
+                previous_is_text = (not_text_num != num - 1
+                                    and is_paragraph_text(previous_line))
+                headings = find_headings_at_line(line, previous_line, num,
+                                                 previous_is_text)
+                if headings or RE_SETEXT_UNDERLINE.match(line):
+                    not_text_num = num
+
+        yield num, line, headings
+
+
+def is_paragraph_text(line):
+    # Blank lines and lines indented like code do not start a paragraph.
+    if not line:
+        return False
+    indent = len(line) - len(line.lstrip())
+    return indent < 4 and '\t' not in line[:indent]
+
+
+def find_headings_at_line(line, previous_line, i, previous_is_text):
+    """
+    Returns any headings detected at 'line' number 'i', which for a
+    Setext-style heading is the underline following the heading text in
+    'previous_line', if that is paragraph text.
+    """
+    first_character = line[:1]
+
+    headings = []
+    if first_character == '#' or first_character == ' ':
+        sr_h = RE_HEADING.match(line)
+        if sr_h:
+            headings += [{'line': i,
+                          'level': len(sr_h.group(1)),
+                          'text': sr_h.group(2)}]
+
+    elif first_character == '=' or first_character == '-':
+        if previous_is_text and RE_SETEXT_UNDERLINE.match(line):
+            headings += [{'line': i - 1,
+                          'level': 1 if first_character == '=' else 2,
+                          'text': previous_line}]
+
+    return headings
+
+
+def find_line_parent_headings(text_lines, start_line):
+    numbered_lines = iter_numbered_lines(text_lines[:start_line + 1])
+
+    parents = []
+    for _, _, headings in iter_tokenized_lines(numbered_lines):
+        parents += reversed(headings)
+    parents.reverse()
 
     return parents
 
@@ -250,13 +1151,67 @@ if __name__ == '__main__':
         if args.ignore_case:
             log.debug('Case-insensitive matching enabled.')
             re_flags = re.IGNORECASE
-        pattern = re.compile(args.pattern[0], re_flags)
+        pattern = PatternMatcher([re.compile(source, re_flags)
+                                  for source in args.patterns])
     except re.error as e:
         log.error('Invalid PATTERN: ' + str(e))
         exit(1)
 
-    results = process_input(fileinput.input(args.file), pattern)
-    display_results(results)
+    # Standard input can not be shared with worker processes.
+    use_jobs = args.jobs > 1 and '-' not in args.file and (
+        args.file or args.recursive)
+    show_filename = len(args.file) > 1 or args.recursive
+
+    filepaths = args.file
+    if args.recursive:
+        filepaths = iter_input_filepaths(args.file or ['.'])
+
+    cache = None
+    cache_path = None
+    if args.cache:
+        cache_path = args.cache_path or get_default_cache_path()
+        try:
+            cache = OutlineCache(cache_path, args.cache_max_entries)
+        except (OSError, sqlite3.Error) as e:
+            log.warning('Not using outline cache "{}": {}'.format(cache_path,
+                                                                  e))
+            cache_path = None
+
+    if use_jobs:
+        matches = iter_parallel_input_matches(filepaths, pattern, args.jobs,
+                                              cache_path)
+    elif (args.stream or args.recursive or cache is not None
+          or args.output_format == 'jsonl'
+          or (len(args.file) == 1 and args.file[0] != '-')):
+        # A single file is searched the same way with or without '--stream',
+        # which allows using the faster per-file search.
+        matches = iter_input_matches(filepaths, pattern, cache)
+    else:
+        matches = None
+
+    if matches is None:
+        results = process_input(fileinput.input(args.file), pattern)
+        display_results(results)
+    elif args.output_format == 'jsonl':
+        filepath = None
+        for match in matches:
+            # Flush once per file, so that results can be used right away
+            # without a system call for every match.
+            if match['file'] != filepath:
+                sys.stdout.flush()
+                filepath = match['file']
+            display_match_json(match)
+    elif args.stream:
+        if args.verbose > 0:
+            print_line('Line', 'Level', 'Heading', 'Matching pattern',
+                       DEFAULT_TEXTWIDTHS)
+        for match in matches:
+            display_match(match, DEFAULT_TEXTWIDTHS, show_filename)
+    else:
+        display_results(list(matches), show_filename)
+
+    if cache:
+        cache.close()
 
     endTime = time.time()
     duration = endTime - startTime
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for 'markdowngrep.py' using generated markdown documents.
+# Run with "python3 markdowngrep_benchmark.py [--lines N] [--matches N ...]".
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+import markdowngrep
+
+
+def legacy_find_line_parent_headings(text_lines, start_line):
+    # Backward scan from the matching line to the first line, as used before
+    # the single pass heading index.  Kept here only for comparison.
+    heading = re.compile(r'^ *(#{1,6}) *([^\n]+?) *#* *(?:\n+|$)')
+    lheading = re.compile(r'^.*?\n[=-]+[ ]*(\n|$)', re.MULTILINE)
+
+    parents = []
+    i = start_line
+    while i >= 0:
+        sr_h = re.match(heading, text_lines[i])
+        if sr_h:
+            parents += [{'line': i,
+                         'level': len(sr_h.group(1)),
+                         'text': sr_h.group(2)}]
+
+        sr_lh = re.match(lheading, text_lines[i - 1] + '\n' + text_lines[i])
+        if sr_lh:
+            if text_lines[i].startswith('='):
+                level = 1
+            else:
+                level = 2
+            parents += [{'line': i - 1,
+                         'level': level,
+                         'text': text_lines[i - 1]}]
+        i -= 1
+
+    return parents
+
+
+def legacy_find_matches(text_lines, pattern):
+    matches = []
+    for num, line in enumerate(text_lines):
+        if line.strip():
+            if markdowngrep.has_match(line, pattern):
+                matches += [{'line': num,
+                             'text': line.strip()}]
+
+    for match in matches:
+        match['parents'] = legacy_find_line_parent_headings(text_lines,
+                                                            match['line'])
+    return matches
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed augue '
+         'nunc ornare blandit quis sagittis eget risus class aptent taciti '
+         'sociosqu litora torquent conubia nostra inceptos himenaeos').split()
+
+
+def generate_document(line_count, match_count, needle='NEEDLE'):
+    rng = random.Random(0)
+    text_lines = ['Title', '=====', '']
+    while len(text_lines) < line_count:
+        kind = rng.random()
+        if kind < 0.04:
+            text_lines += ['', '#' * rng.randint(2, 4) + ' '
+                           + ' '.join(rng.sample(WORDS, 3)), '']
+        elif kind < 0.05:
+            text = ' '.join(rng.sample(WORDS, 3))
+            text_lines += ['', text, '-' * len(text)]
+        elif kind < 0.1:
+            text_lines += ['']
+        else:
+            text_lines += [' '.join(rng.choice(WORDS)
+                                    for _ in range(rng.randint(4, 12)))]
+    del text_lines[line_count:]
+
+    for num in rng.sample(range(3, line_count), match_count):
+        text_lines[num] = '{} {}'.format(text_lines[num], needle)
+    return text_lines
+
+
+def _time(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_find_matches(line_count, match_counts):
+    pattern = re.compile('NEEDLE')
+    print('{:>8s} {:>8s} {:>12s} {:>12s} {:>9s}'.format(
+        'Lines', 'Matches', 'Legacy (s)', 'Indexed (s)', 'Speedup'))
+    for match_count in match_counts:
+        text_lines = generate_document(line_count, match_count)
+        legacy_matches, legacy_elapsed = _time(legacy_find_matches,
+                                               text_lines, pattern)
+        matches, elapsed = _time(markdowngrep.find_matches,
+                                 text_lines, pattern)
+        assert matches == legacy_matches
+        print('{:8d} {:8d} {:12.3f} {:12.3f} {:8.1f}x'.format(
+            line_count, match_count, legacy_elapsed, elapsed,
+            legacy_elapsed / elapsed))
+
+
+def _search_file(filepath, pattern, candidate_pattern, cache=None):
+    return list(markdowngrep.iter_file_matches(filepath, pattern,
+                                               candidate_pattern, cache))
+
+
+# Queries given as lists of "-e PATTERN" arguments.
+QUERIES = (
+    ['NEEDLE'],
+    ['needle', 'haystack'],
+    ['NEEDLE', 'sagittis eget risus'],
+    ['NE+D[LE]+'],
+)
+
+
+def benchmark_file_search(line_count, match_count):
+    text_lines = generate_document(line_count, match_count)
+    with tempfile.NamedTemporaryFile('w', suffix='.md', delete=False) as f:
+        f.write('\n'.join(text_lines) + '\n')
+    try:
+        print('{:>8s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}  {}'.format(
+            'Lines', 'Matches', 'Regex (s)', 'Text (s)', 'Mmap (s)',
+            'Cold (s)', 'Warm (s)', 'Patterns'))
+        for sources in QUERIES:
+            # The patterns as a single regular expression, run on every line.
+            regex = re.compile('|'.join(sources))
+            regex_matches, regex_elapsed = _time(_search_file, f.name,
+                                                 regex, None)
+
+            matcher = markdowngrep.PatternMatcher([re.compile(source)
+                                                   for source in sources])
+            candidate_pattern = markdowngrep.compile_candidate_pattern(matcher)
+            assert candidate_pattern is not None
+            text_matches, text_elapsed = _time(_search_file, f.name,
+                                               matcher, None)
+            matches, elapsed = _time(_search_file, f.name,
+                                     matcher, candidate_pattern)
+            assert matches == text_matches == regex_matches
+
+            # Outline cache, empty and then populated by the first search.
+            cache = markdowngrep.OutlineCache(':memory:')
+            cold_matches, cold_elapsed = _time(_search_file, f.name, matcher,
+                                               candidate_pattern, cache)
+            warm_matches, warm_elapsed = _time(_search_file, f.name, matcher,
+                                               candidate_pattern, cache)
+            cache.close()
+            assert cold_matches == warm_matches == text_matches
+
+            print('{:8d} {:8d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f}  {}'
+                  .format(line_count, len(matches), regex_elapsed,
+                          text_elapsed, elapsed, cold_elapsed, warm_elapsed,
+                          ' '.join('-e {}'.format(s) for s in sources)))
+    finally:
+        os.unlink(f.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks markdowngrep.')
+    parser.add_argument('--lines', default=100000, type=int,
+                        help='Number of lines per generated document.')
+    parser.add_argument('--matches', default=[1, 10, 100], nargs='+',
+                        type=int, help='Number of matching lines to test.')
+    args = parser.parse_args()
+
+    benchmark_find_matches(args.lines, args.matches)
+    print()
+    benchmark_file_search(args.lines * 10, max(args.matches))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,26 @@
 #     ____________________________________________________________________
 
 
+import os
+import re
+import tempfile
 from unittest import TestCase
+from unittest import mock
+from unittest import skipIf
 
+import markdowngrep
+from markdowngrep import OUTLINE_CACHE_VERSION
+from markdowngrep import OutlineCache
+from markdowngrep import ParentHeadings
+from markdowngrep import PatternMatcher
+from markdowngrep import build_outline_index
+from markdowngrep import compile_candidate_pattern
 from markdowngrep import find_line_parent_headings
+from markdowngrep import find_literal_prefix
+from markdowngrep import find_matches
+from markdowngrep import is_utf8_locale
+from markdowngrep import iter_input_filepaths
+from markdowngrep import iter_file_matches
 
 
 class TestMarkdownGrep(TestCase):
@@ -178,3 +195,227 @@ Lorem ipsum dolor sit amet, consectetur adipiscing elit.
                                {'line': 8, 'level': 2,
                                 'text': 'First second level heading'},
                                {'line': 1, 'level': 1, 'text': 'Title'}])
+
+    def test_find_line_parent_headings_skips_code_and_front_matter(self):
+        text_lines = '''---
+title: Front matter
+# Not a heading
+---
+# Title
+```sh
+# Not a heading
+```
+    # Not a heading
+
+---
+Lorem ipsum dolor sit amet.'''.split('\n')
+
+        # The heading in the fenced code block is on line 6.
+        self.assertEqual(find_line_parent_headings(text_lines, 6),
+                         [{'line': 4, 'level': 1, 'text': 'Title'}])
+        self.assertEqual(find_line_parent_headings(text_lines, 11),
+                         [{'line': 4, 'level': 1, 'text': 'Title'}])
+
+
+class TestPatternMatcher(TestCase):
+    LINES = ['', 'a', 'b', 'ab', 'abb', 'ac', 'xabbbx', 'ba', 'AB', 'kelvin',
+             'KELVIN', '\u212aelvin', 'strasse', 'STRASSE', '\u017ftrasse',
+             'Straße', 'café', 'CAFÉ', 'naïve', 'i', 'I', '\u0130', '\u0131']
+
+    def test_find_literal_prefix(self):
+        self.assertEqual(find_literal_prefix('abc'), 'abc')
+        self.assertEqual(find_literal_prefix('abc.d'), 'abc')
+        self.assertEqual(find_literal_prefix('ab*'), 'a')
+        self.assertEqual(find_literal_prefix('ab?c'), 'a')
+        self.assertEqual(find_literal_prefix('ab{0,2}'), 'a')
+        self.assertEqual(find_literal_prefix('ab+'), 'ab')
+        self.assertEqual(find_literal_prefix('a*'), '')
+        self.assertEqual(find_literal_prefix('a|b'), '')
+        self.assertEqual(find_literal_prefix('^ab'), '')
+
+    def test_search_matches_any_pattern(self):
+        for sources, flags in (
+                (['ab*'], 0), (['ab{0,2}'], 0), (['ab?c'], 0), (['a|b'], 0),
+                (['ab+', 'ba'], 0), (['ab'], 0), (['ab', 'ac'], 0),
+                (['b*a'], 0), (['café', 'naïve'], 0),
+                (['kelvin'], re.IGNORECASE), (['strasse'], re.IGNORECASE),
+                (['ab', 'K'], re.IGNORECASE), (['s'], re.IGNORECASE),
+                (['i'], re.IGNORECASE), (['ab*'], re.IGNORECASE),
+                (['café'], re.IGNORECASE), (['Straße'], re.IGNORECASE)):
+            patterns = [re.compile(source, flags) for source in sources]
+            matcher = PatternMatcher(patterns)
+            for line in self.LINES:
+                self.assertEqual(matcher.search(line),
+                                 any(p.search(line) for p in patterns),
+                                 (sources, flags, line))
+
+
+class TestIterInputFilepaths(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirpath = self._tempdir.name
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _write(self, relpath, text=''):
+        filepath = os.path.join(self.dirpath, *relpath.split('/'))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def _find(self, *relpaths):
+        paths = [os.path.join(self.dirpath, *p.split('/')) for p in relpaths]
+        return [os.path.relpath(path, self.dirpath).replace(os.sep, '/')
+                for path in iter_input_filepaths(paths or [self.dirpath])]
+
+    def test_gitignore(self):
+        self._write('.gitignore', '# Comment\nbuild/\n*.tmp.md\n!keep.tmp.md\n'
+                                  '/anchored.md\n')
+        self._write('sub/.gitignore', '!x.tmp.md\nlocal.md\n')
+        for relpath in ('a.md', 'README.MARKDOWN', 'notes.txt', 'anchored.md',
+                        'build/b.md', 'build.md', 'x.tmp.md', 'keep.tmp.md',
+                        'local.md', 'sub/anchored.md', 'sub/build/c.md',
+                        'sub/local.md', 'sub/x.tmp.md', 'sub/y.tmp.md',
+                        'node_modules/d.md', '.git/e.md'):
+            self._write(relpath)
+
+        self.assertEqual(self._find(), [
+            'README.MARKDOWN',
+            'a.md',
+            'build.md',
+            'keep.tmp.md',
+            'local.md',
+            # Anchored patterns only apply in the directory of the
+            # '.gitignore', deeper ones take precedence.
+            'sub/anchored.md',
+            'sub/x.tmp.md',
+        ])
+
+    def test_given_files_are_never_ignored(self):
+        self._write('.gitignore', '*.md\n')
+        self._write('a.md')
+        self.assertEqual(self._find(), [])
+        self.assertEqual(self._find('a.md'), ['a.md'])
+
+
+SAMPLE_MARKDOWN = '''---
+title: Lorem ipsum
+# Not a heading
+---
+Title
+=====
+Lorem ipsum dolor sit amet.
+
+## Second level heading ##
+```sh
+# Not a heading, lorem ipsum
+```
+    # Indented code, lorem ipsum
+
+Setext heading
+--------------
+Ümlaut lorem ipsum dolor.
+~~~
+## Not a heading either
+~~~
+...
+### Third level heading
+LOREM IPSUM in capitals.
+'''
+
+
+class TestParentHeadings(TestCase):
+    def test_behaves_like_a_list_of_the_closest_headings_first(self):
+        headings = [{'line': num, 'level': 1, 'text': str(num)}
+                    for num in range(5)]
+        parents = ParentHeadings(headings, 3)
+        expected = headings[2::-1]
+        # Headings found after the match are not among its parents.
+        headings.append({'line': 5, 'level': 1, 'text': '5'})
+
+        self.assertEqual(parents, expected)
+        self.assertEqual(len(parents), 3)
+        self.assertEqual(parents[0], expected[0])
+        self.assertEqual(parents[-1], expected[-1])
+        self.assertEqual(parents[:2], expected[:2])
+        self.assertEqual(list(reversed(parents)), expected[::-1])
+        with self.assertRaises(IndexError):
+            parents[3]
+        self.assertEqual(ParentHeadings(headings, 0), [])
+
+    def test_matches_have_the_parents_of_their_line(self):
+        text_lines = SAMPLE_MARKDOWN.split('\n')
+        matches = find_matches(text_lines, re.compile('(?i)lorem'))
+        self.assertTrue(matches)
+        for match in matches:
+            self.assertEqual(match['parents'],
+                             find_line_parent_headings(text_lines,
+                                                       match['line']))
+
+
+@skipIf(not is_utf8_locale(), 'requires a UTF-8 locale')
+class TestIterFileMatches(TestCase):
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self._tempdir.name, 'sample.md')
+        with open(self.filepath, 'w', encoding='utf-8') as f:
+            f.write(SAMPLE_MARKDOWN)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _open_cache(self):
+        cache = OutlineCache(os.path.join(self._tempdir.name, 'cache.sqlite3'))
+        self.addCleanup(cache.close)
+        return cache
+
+    def _search(self, matcher, candidate_pattern=None, cache=None):
+        return list(iter_file_matches(self.filepath, matcher,
+                                      candidate_pattern, cache))
+
+    def test_mapped_file_matches_text_search(self):
+        for patterns, flags in ((['lorem'], 0), (['lorem', 'heading'], 0),
+                                (['lo[r]em', 'Not a'], 0),
+                                (['^#+ '], 0), (['lorem'], re.IGNORECASE)):
+            matcher = PatternMatcher([re.compile(p, flags) for p in patterns])
+            candidate_pattern = compile_candidate_pattern(matcher)
+            self.assertIsNotNone(candidate_pattern, patterns)
+
+            expected = self._search(matcher)
+            self.assertTrue(expected, patterns)
+            self.assertEqual(self._search(matcher, candidate_pattern),
+                             expected, patterns)
+
+    def test_cached_outline_matches_text_search(self):
+        cache = self._open_cache()
+        matcher = PatternMatcher([re.compile('lorem', re.IGNORECASE)])
+        expected = self._search(matcher)
+        for candidate_pattern in (None, compile_candidate_pattern(matcher)):
+            # Builds and stores the outline, then reads it back.
+            for _ in range(2):
+                self.assertEqual(self._search(matcher, candidate_pattern,
+                                              cache), expected)
+
+        with open(self.filepath, 'a', encoding='utf-8') as f:
+            f.write('# New heading\nlorem\n')
+        self.assertEqual(self._search(matcher, cache=cache),
+                         self._search(matcher))
+
+    def test_cache_is_invalidated_by_version(self):
+        cache = self._open_cache()
+        cache_key = os.path.realpath(self.filepath)
+        file_stat = os.stat(self.filepath)
+        with open(self.filepath, 'rb') as f:
+            _, line_starts = build_outline_index(f.read())
+        stale_outline = [(0, 0, 1, 'Stale heading')]
+
+        with mock.patch.object(markdowngrep, 'OUTLINE_CACHE_VERSION',
+                               OUTLINE_CACHE_VERSION - 1):
+            cache.put(cache_key, file_stat, stale_outline, line_starts)
+            self.assertEqual(cache.get(cache_key, file_stat)[0], stale_outline)
+
+        self.assertIsNone(cache.get(cache_key, file_stat))
+        matcher = PatternMatcher([re.compile('lorem')])
+        self.assertEqual(self._search(matcher, cache=cache),
+                         self._search(matcher))
@@ -3,34 +3,76 @@
 """
 Compares YAML file data. Ignores formatting, comments, etc.
 
-Both YAML files are parsed and immediately serialized back into a string.
-This round-trip effectively normalizes the YAML data prior to comparison.
+Both YAML files are parsed and the resulting data is compared structurally,
+reporting the key path of every added, removed or changed value.
+Optionally, the data is instead serialized back into a string and displayed
+as a unified diff.  This round-trip effectively normalizes the YAML data
+prior to comparison.
+
+Files containing multiple "---"-separated documents are compared document
+by document, pairing up Kubernetes-style resources by their kind, namespace
+and name, and any other documents by their order.
+
+Given two directories, all YAML files are paired up by their paths relative
+to the directories and compared in parallel.
 
 Returns 0 if the compared files contain equivalent data, otherwise 1.
 Returns 70 on errors.
 """
 
 import argparse
+import collections
 import difflib
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
 import pathlib
 import sys
 import yaml
 
+try:
+    # The libyaml-based C parser is an order of magnitude faster.
+    from yaml import CSafeLoader as YamlLoader
+    YAML_LOADER_BACKEND = 'libyaml (CSafeLoader)'
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+    YAML_LOADER_BACKEND = 'pure Python (SafeLoader)'
+
 
 SELF_BASENAME = str(pathlib.Path(__file__).name)
 LOG = logging.getLogger(SELF_BASENAME)
 
+DIFF_ADDED = '+'
+DIFF_REMOVED = '-'
+DIFF_CHANGED = '~'
+
+OUTPUT_FORMATS = ('paths', 'unified')
+
+YAML_EXTENSIONS = ('.yaml', '.yml')
 
-def load_yaml_file(filehandle):
+# Options for comparing a pair of files, passed to worker processes.
+DiffOptions = collections.namedtuple('DiffOptions', [
+    'coerce_numbers', 'ignore_keys', 'ignore_ordering', 'list_keys',
+    'output_format',
+])
+
+
+def load_yaml_documents(filehandle):
     try:
-        return yaml.safe_load(filehandle)
+        documents = list(yaml.load_all(filehandle, Loader=YamlLoader))
     except (UnicodeDecodeError, ValueError, yaml.YAMLError) as exc:
         LOG.error('Unable to load YAML from file handle %s', filehandle)
         LOG.exception(exc)
         raise exc
 
+    # Like 'yaml.load()', an empty file contains a single null document.
+    return documents or [None]
+
 
+# Always the pure Python dumper, since the libyaml-based 'yaml.CSafeDumper'
+# emits without calling 'increase_indent'.
 class CustomYamlDumper(yaml.SafeDumper):
     # Fixes PyYAML output not conforming to the YAML specification.
     def increase_indent(self, flow=False, indentless=False):
@@ -44,11 +86,35 @@ class CustomYamlDumper(yaml.SafeDumper):
         return True
 
 
+def make_yaml_dumper(options, hasher):
+    # Subclassed so that the representers only apply to this comparison.
+    class _YamlDumper(CustomYamlDumper):
+        pass
+
+    if options.coerce_numbers:
+        # Coerce integer values into strings.
+        def _represent_int_as_string(dumper, data):  # pylint: disable=unused-argument
+            return yaml.ScalarNode('tag:yaml.org,2002:str', str(data))
+
+        _YamlDumper.add_representer(int, _represent_int_as_string)
+
+    if options.ignore_ordering:
+        def _represent_sorted_sequence(dumper, data):
+            # Lists that can not be sorted, like lists of dicts, are put in
+            # the order of the hashes of their elements.
+            sorted_data = sorted_sequence(data, key_function=hasher.digest)
+            return dumper.represent_sequence('tag:yaml.org,2002:seq', sorted_data)
+
+        _YamlDumper.add_representer(list, _represent_sorted_sequence)
+        _YamlDumper.add_representer(tuple, _represent_sorted_sequence)
+
+    return _YamlDumper
+
 
-def serialize_yaml(data):
+def serialize_yaml(data, dumper=CustomYamlDumper):
     bytestring = yaml.dump(
         data,
-        Dumper=CustomYamlDumper,
+        Dumper=dumper,
         encoding='utf8',
         default_flow_style=False,
         width=160,
@@ -81,6 +147,525 @@ def recursively_delete_dict_key(data, keys_to_delete=('do', 'not_want')):
         pass
 
 
+def sorted_sequence(data, key_function=None):
+    if all(isinstance(x, (int, float)) for x in data):
+        # Sort numbers lexicographically instead of numerically.
+        sorting_function = lambda x: str(x)  # pylint: disable=unnecessary-lambda
+    else:
+        # Equivalent to the default sorting behaviour.
+        sorting_function = lambda x: x  # pylint: disable=unnecessary-lambda
+
+    try:
+        return sorted(data, key=sorting_function)
+    except TypeError as exc:
+        # Might be this:
+        # TypeError: '<' not supported between instances of 'dict' and 'dict'
+        LOG.debug(exc)
+        if key_function is None:
+            return data
+        return sorted(data, key=key_function)
+
+
+def scalars_equal(value_a, value_b, coerce_numbers=False):
+    if coerce_numbers:
+        # Compare integer values as strings, like the serialized data.
+        if type(value_a) is int:  # pylint: disable=unidiomatic-typecheck
+            value_a = str(value_a)
+        if type(value_b) is int:  # pylint: disable=unidiomatic-typecheck
+            value_b = str(value_b)
+
+    # Require the same type, since Python considers 'True == 1 == 1.0' while
+    # these are serialized differently.  Not-a-number never equals itself.
+    if type(value_a) is not type(value_b):  # pylint: disable=unidiomatic-typecheck
+        return False
+    return value_a == value_b or (value_a != value_a and value_b != value_b)
+
+
+class SubtreeHasher(object):
+    """
+    Computes canonical content hashes of parsed YAML data, bottom-up.
+
+    Dicts and lists hash the hashes of their keys and elements, so that two
+    subtrees with equal hashes are equivalent and need not be compared.
+    These hashes are memoized per object and every node is only hashed once,
+    no matter how many times its parents are compared.
+    """
+    DIGEST_SIZE = 16
+
+    def __init__(self, coerce_numbers=False, ignore_ordering=False):
+        self.coerce_numbers = coerce_numbers
+        self.ignore_ordering = ignore_ordering
+
+        # Keeps a reference to every hashed object, since the 'id()' of an
+        # object could otherwise be reused after it has been freed.
+        self._digests = {}
+
+        # Keys and values like "name" repeat throughout most documents.
+        self._scalar_digests = {}
+
+    def digest(self, data):
+        if isinstance(data, dict):
+            memoized = self._digests.get(id(data))
+            if memoized is not None:
+                return memoized[1]
+
+            # Mapping keys are unordered.
+            digest = self.digest
+            scalar_digest = self._scalar_digest
+            coerce = self.coerce
+            parts = [scalar_digest(coerce(key)) + digest(value)
+                     for key, value in data.items()]
+            parts.sort()
+            content = b'map:' + b''.join(parts)
+
+        elif isinstance(data, list):
+            memoized = self._digests.get(id(data))
+            if memoized is not None:
+                return memoized[1]
+
+            parts = [self.digest(value) for value in data]
+            if self.ignore_ordering:
+                parts.sort()
+            content = b'seq:' + b''.join(parts)
+
+        else:
+            return self._scalar_digest(self.coerce(data))
+
+        result = hashlib.blake2b(content, digest_size=self.DIGEST_SIZE).digest()
+        self._digests[id(data)] = (data, result)
+        return result
+
+    def coerce(self, data):
+        # Integer keys and values are strings when coercing numbers, like
+        # in the serialized data.
+        if self.coerce_numbers and type(data) is int:  # pylint: disable=unidiomatic-typecheck
+            return str(data)
+        return data
+
+    def _scalar_digest(self, data):
+        # Include the type, like 'scalars_equal()'.
+        memo_key = (type(data), data)
+        try:
+            result = self._scalar_digests.get(memo_key)
+        except TypeError:
+            # Unhashable, like the sets of "!!set" values.
+            memo_key = result = None
+        if result is not None:
+            return result
+
+        if isinstance(data, str):
+            content = data.encode('utf8', 'surrogatepass')
+        else:
+            content = repr(data).encode('utf8')
+        result = hashlib.blake2b(type(data).__name__.encode('utf8') + b':' + content,
+                                 digest_size=self.DIGEST_SIZE).digest()
+        if memo_key is not None:
+            self._scalar_digests[memo_key] = result
+        return result
+
+
+def iter_differences(data_a, data_b, coerce_numbers=False,
+                     ignore_ordering=False, list_keys=(), hasher=None):
+    """
+    Compares parsed YAML data recursively, without serializing it.
+
+    Yields tuples of change, key path, value A and value B for every
+    difference, where the change is one of 'DIFF_ADDED', 'DIFF_REMOVED' and
+    'DIFF_CHANGED' and the key path is a tuple of the dict keys and list
+    indices leading to the values.  A missing value is given as None.
+
+    Subtrees with equal hashes are skipped, so the comparison only descends
+    along the paths leading to the differences.  If ordering is ignored,
+    dicts in lists are paired up by the value of the first of 'list_keys'
+    that they contain, like the "name" of containers.
+    """
+    if hasher is None:
+        hasher = SubtreeHasher(coerce_numbers, ignore_ordering)
+    return _iter_node_differences(data_a, data_b, (), hasher, tuple(list_keys))
+
+
+def _iter_node_differences(data_a, data_b, path, hasher, list_keys):
+    if data_a is data_b:
+        return
+
+    if isinstance(data_a, dict) and isinstance(data_b, dict):
+        if hasher.digest(data_a) == hasher.digest(data_b):
+            return
+
+        # Keys are looked up coerced like they are hashed, so that '1'
+        # and 1 are the same key when coercing numbers.
+        keys_b = {hasher.coerce(key): key for key in data_b}
+        coerced_keys_a = set()
+        for key, value_a in data_a.items():
+            coerced_key = hasher.coerce(key)
+            coerced_keys_a.add(coerced_key)
+            if coerced_key in keys_b:
+                yield from _iter_node_differences(value_a,
+                                                  data_b[keys_b[coerced_key]],
+                                                  path + (key,), hasher,
+                                                  list_keys)
+            else:
+                yield DIFF_REMOVED, path + (key,), value_a, None
+        for coerced_key, key in keys_b.items():
+            if coerced_key not in coerced_keys_a:
+                yield DIFF_ADDED, path + (key,), None, data_b[key]
+
+    elif isinstance(data_a, list) and isinstance(data_b, list):
+        if hasher.digest(data_a) == hasher.digest(data_b):
+            return
+
+        if hasher.ignore_ordering:
+            yield from _iter_unordered_differences(data_a, data_b, path,
+                                                   hasher, list_keys)
+            return
+
+        for index, (value_a, value_b) in enumerate(zip(data_a, data_b)):
+            yield from _iter_node_differences(value_a, value_b,
+                                              path + (index,), hasher,
+                                              list_keys)
+        for index in range(len(data_b), len(data_a)):
+            yield DIFF_REMOVED, path + (index,), data_a[index], None
+        for index in range(len(data_a), len(data_b)):
+            yield DIFF_ADDED, path + (index,), None, data_b[index]
+
+    elif (isinstance(data_a, (dict, list)) or isinstance(data_b, (dict, list))
+          or not scalars_equal(data_a, data_b, hasher.coerce_numbers)):
+        yield DIFF_CHANGED, path, data_a, data_b
+
+
+def _iter_unordered_differences(data_a, data_b, path, hasher, list_keys):
+    # Matches up equal elements as multisets by their hashes, in linear time.
+    unmatched_b = {}
+    for index in reversed(range(len(data_b))):
+        unmatched_b.setdefault(hasher.digest(data_b[index]), []).append(index)
+
+    removed = []
+    for index, value_a in enumerate(data_a):
+        indices_b = unmatched_b.get(hasher.digest(value_a))
+        if indices_b:
+            indices_b.pop()
+        else:
+            removed.append(index)
+
+    added = sorted(index for indices_b in unmatched_b.values()
+                   for index in indices_b)
+    pairs, removed, added = _pair_unmatched_elements(data_a, data_b, removed,
+                                                     added, hasher, list_keys)
+
+    for index_a, index_b in pairs:
+        yield from _iter_node_differences(data_a[index_a], data_b[index_b],
+                                          path + (index_a,), hasher, list_keys)
+    for index in removed:
+        yield DIFF_REMOVED, path + (index,), data_a[index], None
+    for index in added:
+        yield DIFF_ADDED, path + (index,), None, data_b[index]
+
+
+def _pair_unmatched_elements(data_a, data_b, removed, added, hasher,
+                             list_keys):
+    """
+    Pairs up the elements at the 'removed' indices of 'data_a' with those at
+    the 'added' indices of 'data_b', to be compared further.
+
+    Dicts are paired up by the value of the first of 'list_keys' that they
+    contain, and are left unpaired if there is no such dict on the other
+    side.  Any other elements are paired up in their original order.
+    Changes are reported at their index in A.
+
+    Returns the index pairs and the indices of any elements left unpaired.
+    """
+    def _identity(element):
+        if isinstance(element, dict):
+            for key in list_keys:
+                if key in element:
+                    return key, hasher.digest(element[key])
+        return None
+
+    keyed_b = {}
+    unkeyed_b = []
+    for index in added:
+        identity = _identity(data_b[index]) if list_keys else None
+        if identity is None:
+            unkeyed_b.append(index)
+        else:
+            keyed_b.setdefault(identity, collections.deque()).append(index)
+
+    pairs = []
+    unpaired_a = []
+    unkeyed_a = []
+    for index in removed:
+        identity = _identity(data_a[index]) if list_keys else None
+        if identity is None:
+            unkeyed_a.append(index)
+        elif keyed_b.get(identity):
+            pairs.append((index, keyed_b[identity].popleft()))
+        else:
+            unpaired_a.append(index)
+
+    pairs.extend(zip(unkeyed_a, unkeyed_b))
+    unpaired_a.extend(unkeyed_a[len(unkeyed_b):])
+    unpaired_b = [index for indices in keyed_b.values() for index in indices]
+    unpaired_b.extend(unkeyed_b[len(unkeyed_a):])
+
+    pairs.sort()
+    unpaired_a.sort()
+    unpaired_b.sort()
+    return pairs, unpaired_a, unpaired_b
+
+
+def format_key_path(path):
+    # E.G. "spec.template.containers[2].image"
+    parts = []
+    for key in path:
+        if isinstance(key, int) and not isinstance(key, bool):
+            parts.append('[{}]'.format(key))
+        elif parts:
+            parts.append('.{}'.format(key))
+        else:
+            parts.append(str(key))
+    return ''.join(parts) or '.'
+
+
+def format_value(value):
+    # JSON is also valid YAML "flow style" and always fits on a single line.
+    try:
+        return json.dumps(value, ensure_ascii=False, default=str)
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+def format_difference(change, path, value_a, value_b):
+    if change == DIFF_ADDED:
+        return '{} {}: {}'.format(change, format_key_path(path),
+                                  format_value(value_b))
+    if change == DIFF_REMOVED:
+        return '{} {}: {}'.format(change, format_key_path(path),
+                                  format_value(value_a))
+    return '{} {}: {} -> {}'.format(change, format_key_path(path),
+                                    format_value(value_a),
+                                    format_value(value_b))
+
+
+def get_document_identity(document):
+    # Kubernetes-style resources, identified by kind, namespace and name.
+    if not isinstance(document, dict):
+        return None
+    metadata = document.get('metadata')
+    if not isinstance(metadata, dict):
+        return None
+    kind = document.get('kind')
+    name = metadata.get('name')
+    if kind is None or name is None:
+        return None
+    namespace = metadata.get('namespace')
+    return '/'.join(str(part) for part in (kind, namespace, name)
+                    if part is not None)
+
+
+def iter_document_pairs(documents_a, documents_b):
+    """
+    Pairs up the documents of two multi-document YAML streams.
+
+    Yields tuples of a label and the indices of the documents in A and B,
+    where the index is None if the document is missing from that stream.
+    Documents with the same kind, namespace and name are paired up, like
+    the "--list-key" option.  Any other documents are paired up in order.
+    """
+    keyed_b = {}
+    unkeyed_b = []
+    for index, document in enumerate(documents_b):
+        identity = get_document_identity(document)
+        if identity is None:
+            unkeyed_b.append(index)
+        else:
+            keyed_b.setdefault(identity, collections.deque()).append(index)
+
+    unkeyed_a = []
+    for index, document in enumerate(documents_a):
+        identity = get_document_identity(document)
+        if identity is None:
+            unkeyed_a.append(index)
+        elif keyed_b.get(identity):
+            yield identity, index, keyed_b[identity].popleft()
+        else:
+            yield identity, index, None
+
+    for position in range(max(len(unkeyed_a), len(unkeyed_b))):
+        index_a = unkeyed_a[position] if position < len(unkeyed_a) else None
+        index_b = unkeyed_b[position] if position < len(unkeyed_b) else None
+        label = 'document {}'.format((index_a if index_a is not None else index_b) + 1)
+        yield label, index_a, index_b
+
+    for identity, indices_b in keyed_b.items():
+        for index in indices_b:
+            yield identity, None, index
+
+
+def compare_yaml_streams(filehandle_a, filehandle_b, options):
+    """
+    Compares the YAML documents read from two file handles.
+
+    Returns a tuple of the exit code and the lines of output.
+    """
+    try:
+        documents_a = load_yaml_documents(filehandle_a)
+        documents_b = load_yaml_documents(filehandle_b)
+    except Exception as exc:  # pylint: disable=broad-except
+        LOG.critical('Caught top-level exception!')
+        LOG.exception(exc)
+        return 70, []
+
+    if options.ignore_keys:
+        LOG.debug('Filtering out dict key(s): %s', ', '.join(options.ignore_keys))
+        for document in documents_a + documents_b:
+            recursively_delete_dict_key(document, options.ignore_keys)
+
+    hasher = SubtreeHasher(
+        coerce_numbers=options.coerce_numbers,
+        ignore_ordering=options.ignore_ordering,
+    )
+    is_multi_document = len(documents_a) > 1 or len(documents_b) > 1
+
+    lines = []
+    for label, index_a, index_b in iter_document_pairs(documents_a, documents_b):
+        if index_b is None:
+            differences = iter([(DIFF_REMOVED, (), documents_a[index_a], None)])
+        elif index_a is None:
+            differences = iter([(DIFF_ADDED, (), None, documents_b[index_b])])
+        else:
+            differences = iter_differences(
+                documents_a[index_a],
+                documents_b[index_b],
+                list_keys=options.list_keys,
+                hasher=hasher,
+            )
+
+        if options.output_format == 'paths':
+            document_lines = [format_difference(*difference)
+                              for difference in differences]
+            if document_lines and is_multi_document:
+                # Like the start of the document in a multi-document stream.
+                lines.append('--- # {}'.format(label))
+            lines.extend(document_lines)
+            continue
+
+        # Only serialize the data if it actually differs.
+        if next(differences, None) is None:
+            continue
+
+        dumper = make_yaml_dumper(options, hasher)
+        data_a_text = serialize_yaml(documents_a[index_a], dumper) if index_a is not None else ''
+        data_b_text = serialize_yaml(documents_b[index_b], dumper) if index_b is not None else ''
+        LOG.debug('Serialized data from file "%s":\n%s', filehandle_a.name, data_a_text)
+        LOG.debug('Serialized data from file "%s":\n%s', filehandle_b.name, data_b_text)
+
+        fromfile = filehandle_a.name
+        tofile = filehandle_b.name
+        if is_multi_document:
+            fromfile = '{} ({})'.format(fromfile, label)
+            tofile = '{} ({})'.format(tofile, label)
+        lines.extend(difflib.unified_diff(
+            data_a_text.splitlines(),
+            data_b_text.splitlines(),
+            fromfile=fromfile,
+            tofile=tofile,
+        ))
+
+    if not lines:
+        LOG.debug('No differences found, data is equivalent')
+        return 0, lines
+    return 1, lines
+
+
+def find_yaml_files(dirpath):
+    # Maps relative paths to the YAML files in the directory tree.
+    dirpath = pathlib.Path(dirpath)
+    return {
+        filepath.relative_to(dirpath).as_posix(): filepath
+        for filepath in dirpath.rglob('*')
+        if filepath.suffix.lower() in YAML_EXTENSIONS and filepath.is_file()
+    }
+
+
+def compare_yaml_file_pair(job):
+    # Run in worker processes, so takes a single picklable argument.
+    relpath, filepath_a, filepath_b, options = job
+    try:
+        with open(filepath_a, encoding='utf8') as filehandle_a, \
+                open(filepath_b, encoding='utf8') as filehandle_b:
+            return relpath, compare_yaml_streams(filehandle_a, filehandle_b, options)
+    except OSError as exc:
+        LOG.error('Unable to compare "%s": %s', relpath, exc)
+        return relpath, (70, [])
+
+
+def compare_directories(dirpath_a, dirpath_b, options, jobs):
+    """
+    Compares all YAML files in two directory trees, paired up by their
+    relative paths, using a pool of 'jobs' worker processes.
+
+    Prints the differences of every changed file followed by a summary and
+    returns the exit code.
+    """
+    filepaths_a = find_yaml_files(dirpath_a)
+    filepaths_b = find_yaml_files(dirpath_b)
+    removed = sorted(set(filepaths_a) - set(filepaths_b))
+    added = sorted(set(filepaths_b) - set(filepaths_a))
+    pair_jobs = [
+        (relpath, filepaths_a[relpath], filepaths_b[relpath], options)
+        for relpath in sorted(set(filepaths_a) & set(filepaths_b))
+    ]
+    LOG.info('Comparing %d pairs of files using %d jobs', len(pair_jobs), jobs)
+
+    changed = []
+    failed = []
+    unchanged_count = 0
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(pair_jobs) > 1 else None
+    try:
+        if pool is None:
+            results = map(compare_yaml_file_pair, pair_jobs)
+        else:
+            results = pool.imap(compare_yaml_file_pair, pair_jobs)
+
+        for relpath, (exit_code, lines) in results:
+            if exit_code == 0:
+                unchanged_count += 1
+                continue
+            if exit_code != 1:
+                failed.append(relpath)
+                continue
+
+            changed.append(relpath)
+            if options.output_format == 'paths':
+                print('=== {}'.format(relpath))
+            print('\n'.join(lines))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for relpath in removed:
+        print('Only in {}: {}'.format(dirpath_a, relpath))
+    for relpath in added:
+        print('Only in {}: {}'.format(dirpath_b, relpath))
+    for relpath in failed:
+        print('Failed to compare: {}'.format(relpath))
+    print('{} changed, {} added, {} removed, {} unchanged, {} failed'.format(
+        len(changed), len(added), len(removed), unchanged_count, len(failed)))
+
+    if failed:
+        return 70
+    if changed or added or removed:
+        return 1
+    return 0
+
+
+def open_input_file(filepath):
+    if filepath == '-':
+        return sys.stdin
+    return open(filepath, encoding='utf8')
+
+
 def cli_main(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -91,11 +676,11 @@ def cli_main(args=sys.argv[1:]):
     parser.add_argument(
         dest='filepaths',
         help='''
-File(s) to read. Use "-" to read from stdin.
+File(s) to read. Use "-" to read from stdin. Give two directories to compare
+all YAML files with the same relative paths.
 ''',
         metavar='FILEPATH',
         nargs=2,
-        type=argparse.FileType('r', encoding='utf8')
     )
 
     parser.add_argument(
@@ -131,6 +716,43 @@ Default: %(default)s
 ''',
     )
 
+    parser.add_argument(
+        '--list-key',
+        action='append',
+        default=[],
+        dest='list_keys',
+        metavar='KEY',
+        help='''
+Pair up dicts in lists by the value of this key when ignoring ordering, like
+the "name" of containers. Repeat to try several keys, in the given order.
+Default: %(default)s
+''',
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=OUTPUT_FORMATS,
+        default='paths',
+        dest='output_format',
+        help='''
+Output format. "paths" lists the key path of every added (+), removed (-) and
+changed (~) value. "unified" displays a unified diff of the normalized data.
+Default: %(default)s
+''',
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        default=os.cpu_count() or 1,
+        dest='jobs',
+        metavar='N',
+        type=int,
+        help='''
+Number of worker processes used to compare directories.
+Default: %(default)s
+''',
+    )
+
     parser.add_argument(
         '-v',
         action='count',
@@ -144,6 +766,10 @@ Default: %(default)s
     )
 
     parsed_args = parser.parse_args(args)
+    if parsed_args.list_keys and not parsed_args.ignore_element_ordering:
+        parser.error('argument --list-key: requires --ignore-ordering')
+    if parsed_args.jobs < 1:
+        parser.error('argument -j/--jobs: must be at least 1')
 
     loglevel = {
         0: logging.WARNING,
@@ -154,74 +780,42 @@ Default: %(default)s
         format='%(name)s: %(levelname)8s %(message)s',
         level=loglevel,
     )
+    LOG.debug('Using YAML loader: %s', YAML_LOADER_BACKEND)
 
     filepath_a, filepath_b = parsed_args.filepaths
 
-    if parsed_args.coerce_numbers:
-        # Coerce integer values into strings.
-        def _represent_int_as_string(dumper, data):  # pylint: disable=unused-argument
-            return yaml.ScalarNode('tag:yaml.org,2002:str', str(data))
-
-        CustomYamlDumper.add_representer(int, _represent_int_as_string)
-
-    if parsed_args.ignore_element_ordering:
-        def _represent_sorted_sequence(dumper, data):
-            # pylint: disable=unused-argument
-            # pylint: disable=unnecessary-lambda
-
-            if all(isinstance(x, (int, float)) for x in data):
-                # Sort numbers lexicographically instead of numerically.
-                sorting_function = lambda x: str(x)
-            else:
-                # Equivalent to the default sorting behaviour.
-                sorting_function = lambda x: x
-
-            try:
-                sorted_data = sorted(data, key=sorting_function)
-            except TypeError as exc:
-                # Might be this:
-                # TypeError: '<' not supported between instances of 'dict' and 'dict'
-                LOG.debug(exc)
-                sorted_data = data
-
-            return dumper.represent_sequence('tag:yaml.org,2002:seq', sorted_data)
-
-        CustomYamlDumper.add_representer(list, _represent_sorted_sequence)
-        CustomYamlDumper.add_representer(tuple, _represent_sorted_sequence)
-
-    try:
-        data_a = load_yaml_file(filepath_a)
-        data_b = load_yaml_file(filepath_b)
-    except Exception as exc:  # pylint: disable=broad-except
-        LOG.critical('Caught top-level exception!')
-        LOG.exception(exc)
-        return 70
-
-    if parsed_args.ignore_keys:
-        LOG.debug('Elements to compare; A: %d, B: %d', len(data_a), len(data_b))
-        LOG.debug('Filtering out dict key(s): %s', ', '.join(parsed_args.ignore_keys))
-        recursively_delete_dict_key(data_a, parsed_args.ignore_keys)
-        recursively_delete_dict_key(data_b, parsed_args.ignore_keys)
-        LOG.debug('Elements to compare; A: %d, B: %d', len(data_a), len(data_b))
-
-    data_a_text = serialize_yaml(data_a)
-    data_b_text = serialize_yaml(data_b)
-    LOG.debug('Serialized data from file "%s":\n%s', filepath_a.name, data_a_text)
-    LOG.debug('Serialized data from file "%s":\n%s', filepath_b.name, data_b_text)
-
-    diff_generator = difflib.unified_diff(
-        data_a_text.splitlines(),
-        data_b_text.splitlines(),
-        fromfile=filepath_a.name,
-        tofile=filepath_b.name,
+    options = DiffOptions(
+        coerce_numbers=parsed_args.coerce_numbers,
+        ignore_keys=parsed_args.ignore_keys,
+        ignore_ordering=parsed_args.ignore_element_ordering,
+        list_keys=parsed_args.list_keys,
+        output_format=parsed_args.output_format,
     )
-    diff = '\n'.join(diff_generator)
-    if not diff:
-        LOG.debug('Diff is empty, normalized data is equivalent')
-        return 0
 
-    print(diff)
-    return 1
+    is_directory_a = os.path.isdir(filepath_a)
+    is_directory_b = os.path.isdir(filepath_b)
+    if is_directory_a and is_directory_b:
+        return compare_directories(filepath_a, filepath_b, options,
+                                   parsed_args.jobs)
+    if is_directory_a or is_directory_b:
+        parser.error('argument FILEPATH: can not compare a file with a directory')
+
+    def _open_input_file(filepath):
+        # Unreadable files are usage errors, like with 'argparse.FileType'.
+        try:
+            return open_input_file(filepath)
+        except OSError as exc:
+            parser.error("argument FILEPATH: can't open '{}': {}".format(
+                filepath, exc))
+
+    with _open_input_file(filepath_a) as filehandle_a, \
+            _open_input_file(filepath_b) as filehandle_b:
+        exit_code, lines = compare_yaml_streams(filehandle_a, filehandle_b,
+                                                options)
+
+    if lines:
+        print('\n'.join(lines))
+    return exit_code
 
 
 if __name__ == '__main__':
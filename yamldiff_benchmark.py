@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Benchmarks for 'yamldiff.py' using generated Kubernetes-like manifests.
+# Run with "python3 yamldiff_benchmark.py [--resources N] [--changes N ...]".
+
+import argparse
+import copy
+import difflib
+import io
+import random
+import time
+
+import yaml
+
+import yamldiff
+
+
+def generate_resource(rng, index):
+    name = 'service-{:05d}'.format(index)
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {
+            'name': name,
+            'labels': {'app': name, 'tier': rng.choice(['web', 'db', 'cache'])},
+        },
+        'spec': {
+            'replicas': rng.randint(1, 5),
+            'template': {
+                'spec': {
+                    'containers': [
+                        {
+                            'name': '{}-{}'.format(name, container),
+                            'image': 'registry.example.com/{}:1.{}.{}'.format(
+                                name, rng.randint(0, 9), rng.randint(0, 99)),
+                            'env': [{'name': 'VAR_{}'.format(var),
+                                     'value': str(rng.random())}
+                                    for var in range(rng.randint(2, 8))],
+                            'ports': [{'containerPort': 8000 + port,
+                                       'protocol': 'TCP'}
+                                      for port in range(rng.randint(1, 3))],
+                        }
+                        for container in range(rng.randint(1, 3))
+                    ],
+                },
+            },
+        },
+    }
+
+
+def generate_documents(resource_count, change_count):
+    rng = random.Random(0)
+    data_a = {'items': [generate_resource(rng, index)
+                        for index in range(resource_count)]}
+    data_b = copy.deepcopy(data_a)
+    for resource in rng.sample(data_b['items'], change_count):
+        container = rng.choice(resource['spec']['template']['spec']['containers'])
+        container['image'] += '-patched'
+    return data_a, data_b
+
+
+def shuffle_lists(rng, data):
+    if isinstance(data, dict):
+        for value in data.values():
+            shuffle_lists(rng, value)
+    elif isinstance(data, list):
+        rng.shuffle(data)
+        for value in data:
+            shuffle_lists(rng, value)
+    return data
+
+
+def _time(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def legacy_diff(data_a, data_b):
+    # Serialize-then-difflib, as used before the structural comparison.
+    return list(difflib.unified_diff(
+        yamldiff.serialize_yaml(data_a).splitlines(),
+        yamldiff.serialize_yaml(data_b).splitlines(),
+    ))
+
+
+def structural_diff(data_a, data_b):
+    return list(yamldiff.iter_differences(data_a, data_b))
+
+
+def unordered_structural_diff(data_a, data_b):
+    # Resources are identified by their metadata, containers by name.
+    return list(yamldiff.iter_differences(data_a, data_b, ignore_ordering=True,
+                                          list_keys=['metadata', 'name']))
+
+
+def benchmark_differences(resource_count, change_counts):
+    print('{:>10s} {:>8s} {:>12s} {:>15s} {:>9s} {:>14s}'.format(
+        'Resources', 'Changes', 'Legacy (s)', 'Structural (s)', 'Speedup',
+        'Unordered (s)'))
+    for change_count in change_counts:
+        data_a, data_b = generate_documents(resource_count, change_count)
+        _, legacy_elapsed = _time(legacy_diff, data_a, data_b)
+        differences, elapsed = _time(structural_diff, data_a, data_b)
+        assert len(differences) == change_count
+
+        # Every list shuffled, compared ignoring the ordering.
+        shuffle_lists(random.Random(1), data_b)
+        differences, unordered_elapsed = _time(unordered_structural_diff,
+                                               data_a, data_b)
+        assert len(differences) == change_count
+
+        print('{:10d} {:8d} {:12.3f} {:15.3f} {:8.1f}x {:14.3f}'.format(
+            resource_count, change_count, legacy_elapsed, elapsed,
+            legacy_elapsed / elapsed, unordered_elapsed))
+
+
+def _load_documents(text, loader):
+    return list(yaml.load_all(io.StringIO(text), Loader=loader))
+
+
+def _serialize_documents(documents):
+    return [yamldiff.serialize_yaml(document) for document in documents]
+
+
+def benchmark_loading(resource_count):
+    data, _ = generate_documents(resource_count, 0)
+    text = yaml.dump_all(data['items'], Dumper=yaml.SafeDumper)
+    print('Loader: {}'.format(yamldiff.YAML_LOADER_BACKEND))
+    print('{:>10s} {:>10s} {:>14s} {:>14s} {:>9s} {:>14s}'.format(
+        'Resources', 'Size (MB)', 'Python (s)', 'Loader (s)', 'Speedup',
+        'Normalize (s)'))
+
+    python_documents, python_elapsed = _time(_load_documents, text,
+                                             yaml.SafeLoader)
+    documents, elapsed = _time(_load_documents, text, yamldiff.YamlLoader)
+    assert documents == python_documents
+    _, normalize_elapsed = _time(_serialize_documents, documents)
+    print('{:10d} {:10.1f} {:14.3f} {:14.3f} {:8.1f}x {:14.3f}'.format(
+        resource_count, len(text) / 1e6, python_elapsed, elapsed,
+        python_elapsed / elapsed, normalize_elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks yamldiff.')
+    parser.add_argument('--resources', default=1000, type=int,
+                        help='Number of resources per generated document.')
+    parser.add_argument('--changes', default=[0, 10, 100], nargs='+',
+                        type=int, help='Number of changed values to test.')
+    args = parser.parse_args()
+
+    benchmark_loading(args.resources)
+    print()
+    benchmark_differences(args.resources, args.changes)
+
+
+if __name__ == '__main__':
+    main()
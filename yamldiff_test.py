@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from yamldiff import DIFF_ADDED
+from yamldiff import DIFF_CHANGED
+from yamldiff import DIFF_REMOVED
+from yamldiff import DiffOptions
+from yamldiff import SubtreeHasher
+from yamldiff import cli_main
+from yamldiff import compare_yaml_streams
+from yamldiff import format_key_path
+from yamldiff import iter_differences
+from yamldiff import iter_document_pairs
+
+
+class TestIterDifferences(TestCase):
+    def setUp(self):
+        self.data_a = {
+            'spec': {
+                'replicas': 1,
+                'containers': [{'name': 'a', 'image': 'nginx:1.0'},
+                               {'name': 'b', 'ports': [80, 443]}],
+            },
+            'removed': True,
+        }
+        self.data_b = {
+            'spec': {
+                'replicas': '1',
+                'containers': [{'name': 'a', 'image': 'nginx:1.1'},
+                               {'name': 'b', 'ports': [443, 80]}],
+            },
+            'added': 1.0,
+        }
+
+    def test_equivalent_data(self):
+        self.assertEqual(list(iter_differences(self.data_a, self.data_a)), [])
+        self.assertEqual(list(iter_differences({'a': [float('nan')]},
+                                               {'a': [float('nan')]})), [])
+
+    def test_reports_key_paths(self):
+        self.assertEqual(
+            list(iter_differences(self.data_a, self.data_b)),
+            [(DIFF_CHANGED, ('spec', 'replicas'), 1, '1'),
+             (DIFF_CHANGED, ('spec', 'containers', 0, 'image'),
+              'nginx:1.0', 'nginx:1.1'),
+             (DIFF_CHANGED, ('spec', 'containers', 1, 'ports', 0), 80, 443),
+             (DIFF_CHANGED, ('spec', 'containers', 1, 'ports', 1), 443, 80),
+             (DIFF_REMOVED, ('removed',), True, None),
+             (DIFF_ADDED, ('added',), None, 1.0)])
+
+    def test_coerce_numbers_and_ignore_ordering(self):
+        self.assertEqual(
+            list(iter_differences(self.data_a, self.data_b,
+                                  coerce_numbers=True, ignore_ordering=True)),
+            [(DIFF_CHANGED, ('spec', 'containers', 0, 'image'),
+              'nginx:1.0', 'nginx:1.1'),
+             (DIFF_REMOVED, ('removed',), True, None),
+             (DIFF_ADDED, ('added',), None, 1.0)])
+
+    def test_coerce_numbers_applies_to_keys(self):
+        data_a = {1: 'a', 'b': {2: 'c'}, 3: 'd'}
+        data_b = {'1': 'a', 'b': {'2': 'x'}, 4: 'd'}
+        self.assertEqual(
+            list(iter_differences(data_a, data_b, coerce_numbers=True)),
+            [(DIFF_CHANGED, ('b', 2), 'c', 'x'),
+             (DIFF_REMOVED, (3,), 'd', None),
+             (DIFF_ADDED, (4,), None, 'd')])
+        self.assertEqual(list(iter_differences({1: 'a'}, {'1': 'a'})),
+                         [(DIFF_REMOVED, (1,), 'a', None),
+                          (DIFF_ADDED, ('1',), None, 'a')])
+
+    def test_type_changes(self):
+        self.assertEqual(list(iter_differences({'a': True}, {'a': 1})),
+                         [(DIFF_CHANGED, ('a',), True, 1)])
+        self.assertEqual(list(iter_differences({'a': [1]}, {'a': {0: 1}})),
+                         [(DIFF_CHANGED, ('a',), [1], {0: 1})])
+
+    def test_format_key_path(self):
+        self.assertEqual(format_key_path(('spec', 'containers', 2, 'image')),
+                         'spec.containers[2].image')
+        self.assertEqual(format_key_path((0, 'a')), '[0].a')
+        self.assertEqual(format_key_path(()), '.')
+
+    def test_ignore_ordering_matches_elements_by_hash(self):
+        data_a = {'env': [{'name': 'A', 'value': '1'},
+                          {'name': 'B', 'value': '2'},
+                          {'name': 'C', 'value': '3'}]}
+        data_b = {'env': [{'name': 'C', 'value': '3'},
+                          {'name': 'A', 'value': '1'},
+                          {'name': 'B', 'value': '4'}]}
+        self.assertEqual(
+            list(iter_differences(data_a, data_b, ignore_ordering=True)),
+            [(DIFF_CHANGED, ('env', 1, 'value'), '2', '4')])
+        self.assertEqual(
+            list(iter_differences(data_a, {'env': data_b['env'][:2]},
+                                  ignore_ordering=True)),
+            [(DIFF_REMOVED, ('env', 1), {'name': 'B', 'value': '2'}, None)])
+
+        self.assertEqual(
+            list(iter_differences([1, 1, 2], [2, 1, 2], ignore_ordering=True)),
+            [(DIFF_CHANGED, (1,), 1, 2)])
+
+    def test_list_keys_pair_up_dicts(self):
+        data_a = [{'name': 'web', 'image': 'nginx:1.0'},
+                  {'name': 'old', 'image': 'x'},
+                  {'name': 'sidecar', 'image': 'envoy:1'}]
+        data_b = [{'name': 'sidecar', 'image': 'envoy:2'},
+                  {'name': 'new', 'image': 'y'},
+                  {'name': 'web', 'image': 'nginx:1.0'}]
+        self.assertEqual(
+            list(iter_differences(data_a, data_b, ignore_ordering=True,
+                                  list_keys=['id', 'name'])),
+            [(DIFF_CHANGED, (2, 'image'), 'envoy:1', 'envoy:2'),
+             (DIFF_REMOVED, (1,), {'name': 'old', 'image': 'x'}, None),
+             (DIFF_ADDED, (1,), None, {'name': 'new', 'image': 'y'})])
+
+
+class TestSubtreeHasher(TestCase):
+    def test_equivalent_data_hashes_equal(self):
+        hasher = SubtreeHasher()
+        self.assertEqual(hasher.digest({'a': [1, {'b': None}], 'c': 'd'}),
+                         hasher.digest({'c': 'd', 'a': [1, {'b': None}]}))
+        self.assertNotEqual(hasher.digest([1, 2]), hasher.digest([2, 1]))
+        self.assertNotEqual(hasher.digest([1]), hasher.digest([True]))
+        self.assertNotEqual(hasher.digest([1]), hasher.digest(['1']))
+
+    def test_options_change_hashes(self):
+        self.assertEqual(SubtreeHasher(coerce_numbers=True).digest([1]),
+                         SubtreeHasher(coerce_numbers=True).digest(['1']))
+        self.assertEqual(SubtreeHasher(coerce_numbers=True).digest({1: 'a'}),
+                         SubtreeHasher(coerce_numbers=True).digest({'1': 'a'}))
+        self.assertNotEqual(SubtreeHasher().digest({1: 'a'}),
+                            SubtreeHasher().digest({'1': 'a'}))
+        self.assertEqual(SubtreeHasher(ignore_ordering=True).digest([1, 2]),
+                         SubtreeHasher(ignore_ordering=True).digest([2, 1]))
+
+
+class TestMultiDocumentComparison(TestCase):
+    def setUp(self):
+        self.options = DiffOptions(
+            coerce_numbers=False,
+            ignore_keys=[],
+            ignore_ordering=False,
+            list_keys=[],
+            output_format='paths',
+        )
+
+    def test_iter_document_pairs(self):
+        documents_a = [{'kind': 'Deployment', 'metadata': {'name': 'web'}},
+                       {'kind': 'Service', 'metadata': {'name': 'web'}},
+                       'unnamed']
+        documents_b = [{'kind': 'Service', 'metadata': {'name': 'web'}},
+                       {'kind': 'Secret',
+                        'metadata': {'name': 'key', 'namespace': 'prod'}}]
+        self.assertEqual(list(iter_document_pairs(documents_a, documents_b)),
+                         [('Deployment/web', 0, None),
+                          ('Service/web', 1, 0),
+                          ('document 3', 2, None),
+                          ('Secret/prod/key', None, 1)])
+
+    def test_compare_yaml_streams(self):
+        stream_a = io.StringIO('kind: A\nmetadata: {name: a}\nx: 1\n'
+                               '---\nkind: B\nmetadata: {name: b}\n')
+        stream_b = io.StringIO('kind: B\nmetadata: {name: b}\n'
+                               '---\nkind: A\nmetadata: {name: a}\nx: 2\n')
+        self.assertEqual(compare_yaml_streams(stream_a, stream_b, self.options),
+                         (1, ['--- # A/a', '~ x: 1 -> 2']))
+
+        self.assertEqual(compare_yaml_streams(io.StringIO(''), io.StringIO(''),
+                                              self.options),
+                         (0, []))
+
+
+class TestCliMain(TestCase):
+    def test_unreadable_file_is_a_usage_error(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, 'a.yaml')
+            with open(filepath, 'w', encoding='utf8') as filehandle:
+                filehandle.write('a: 1\n')
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(cli_main([filepath, filepath]), 0)
+            with self.assertRaises(SystemExit) as context, \
+                    contextlib.redirect_stderr(io.StringIO()):
+                cli_main([filepath, os.path.join(dirpath, 'missing.yaml')])
+            self.assertEqual(context.exception.code, 2)